@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the servers, which doesn't need Maelstrom. Nodes are run on a
+simulated network, see `netsim.Network`, and the clients send requests at a
+fixed rate regardless of how fast the replies come back. Arguments after
+`--` are passed to `maelstrom_server`, e.g.
+
+    ./bench.py -w broadcast -n 5 --rate 500 --latency 5 -- --topology tree
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+
+from collections import Counter
+
+from netsim import Network
+
+
+def call(net, dest, body, timeout=5):
+    """
+    Synchronous request used outside of the measured load.
+    """
+    done = threading.Event()
+    resp = {}
+
+    def callback(body):
+        resp.update(body)
+        done.set()
+
+    net.rpc("c0", dest, body, callback)
+    if not done.wait(timeout):
+        return None
+    return resp
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Workload:
+    READ_RATIO = 0.2
+
+    def setup(self, net):
+        pass
+
+    def request(self, i):
+        raise NotImplementedError()
+
+    def ok(self, req, resp):
+        pass
+
+    def check(self, net):
+        return {}
+
+
+class EchoWorkload(Workload):
+
+    def request(self, i):
+        return {"type": "echo", "echo": "Please echo {}".format(i)}
+
+
+class SetWorkload(Workload):
+    """
+    Adds unique elements to a set and checks that all acknowledged elements
+    were eventually read from all the nodes.
+    """
+    READ_FIELD = None
+
+    def __init__(self):
+        self.acked = set()
+        self._lock = threading.Lock()
+
+    def request(self, i):
+        if random.random() < self.READ_RATIO:
+            return {"type": "read"}
+        return self._add(i)
+
+    def _add(self, i):
+        raise NotImplementedError()
+
+    def ok(self, req, resp):
+        if req["type"] != "read":
+            with self._lock:
+                self.acked.add(self._element(req))
+
+    def _element(self, req):
+        raise NotImplementedError()
+
+    def check(self, net):
+        lost = {}
+        for node_id in net.node_ids:
+            resp = call(net, node_id, {"type": "read"})
+            if resp is None:
+                lost[node_id] = None
+            else:
+                lost[node_id] = len(self.acked - set(resp[self.READ_FIELD]))
+        return {"acked": len(self.acked), "lost": lost}
+
+
+class BroadcastWorkload(SetWorkload):
+    READ_FIELD = "messages"
+
+    def setup(self, net):
+        # Grid, which Maelstrom uses by default.
+        nodes = net.node_ids
+        width = math.ceil(math.sqrt(len(nodes)))
+        topology = {}
+        for i, node_id in enumerate(nodes):
+            neighbors = []
+            if i % width > 0:
+                neighbors.append(nodes[i - 1])
+            if i % width < width - 1 and i + 1 < len(nodes):
+                neighbors.append(nodes[i + 1])
+            if i >= width:
+                neighbors.append(nodes[i - width])
+            if i + width < len(nodes):
+                neighbors.append(nodes[i + width])
+            topology[node_id] = neighbors
+        for node_id in nodes:
+            call(net, node_id, {"type": "topology", "topology": topology})
+
+    def _add(self, i):
+        return {"type": "broadcast", "message": i}
+
+    def _element(self, req):
+        return req["message"]
+
+
+class GSetWorkload(SetWorkload):
+    READ_FIELD = "value"
+
+    def _add(self, i):
+        return {"type": "add", "element": i}
+
+    def _element(self, req):
+        return req["element"]
+
+
+class CounterWorkload(Workload):
+    """
+    Adds random deltas to a counter and checks that all the nodes eventually
+    read the sum of acknowledged deltas. Deltas, which timed out, may or may
+    not be included.
+    """
+
+    def __init__(self, negative):
+        self.negative = negative
+        self.acked = 0
+        self._lock = threading.Lock()
+
+    def request(self, i):
+        if random.random() < self.READ_RATIO:
+            return {"type": "read"}
+        delta = random.randint(1, 5)
+        if self.negative and random.random() < 0.5:
+            delta = -delta
+        return {"type": "add", "delta": delta}
+
+    def ok(self, req, resp):
+        if req["type"] == "add":
+            with self._lock:
+                self.acked += req["delta"]
+
+    def check(self, net):
+        values = {}
+        for node_id in net.node_ids:
+            resp = call(net, node_id, {"type": "read"})
+            values[node_id] = resp and resp["value"]
+        return {"acked": self.acked, "values": values}
+
+
+class TxnWorkload(Workload):
+    KEYS = 8
+    MAX_OPS = 4
+
+    def request(self, i):
+        txn = []
+        for j in range(random.randint(1, self.MAX_OPS)):
+            key = random.randrange(self.KEYS)
+            if random.random() < 0.5:
+                txn.append(["r", key, None])
+            else:
+                txn.append(["append", key, i * self.MAX_OPS + j])
+        return {"type": "txn", "txn": txn}
+
+
+WORKLOADS = {
+    "echo": EchoWorkload,
+    "broadcast": BroadcastWorkload,
+    "g-set": GSetWorkload,
+    "g-counter": lambda: CounterWorkload(False),
+    "pn-counter": lambda: CounterWorkload(True),
+    "txn": TxnWorkload,
+}
+
+
+class Nemesis:
+    """
+    Every `interval` seconds either splits the nodes into random majority
+    and minority or heals the partition.
+    """
+
+    def __init__(self, net, interval):
+        self.net = net
+        self.interval = interval
+        self.partitions = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.net.heal()
+
+    def _run(self):
+        partitioned = False
+        while not self._stop.wait(self.interval):
+            if partitioned:
+                self.net.heal()
+            else:
+                nodes = random.sample(self.net.node_ids, len(self.net.node_ids))
+                majority = len(nodes) // 2 + 1
+                self.net.partition([nodes[:majority], nodes[majority:]])
+                self.partitions += 1
+            partitioned = not partitioned
+
+
+class Bench:
+
+    def __init__(self, net, workload, rate, duration, clients=10,
+                 max_pending=1000, timeout=5):
+        self.net = net
+        self.workload = workload
+        self.rate = rate
+        self.duration = duration
+        self.clients = ["c{}".format(i) for i in range(1, clients + 1)]
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.latencies = []
+        self.errors = Counter()
+        self.sent = 0
+        self.skipped = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def run(self):
+        start = time.monotonic()
+        for i in range(int(self.rate * self.duration)):
+            delay = start + i / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if len(self._pending) >= self.max_pending:
+                self.skipped += 1
+                continue
+            self._send(i)
+        elapsed = time.monotonic() - start
+
+        deadline = time.monotonic() + self.timeout
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return elapsed
+
+    def _send(self, i):
+        req = self.workload.request(i)
+        client = self.clients[i % len(self.clients)]
+        node_id = self.net.node_ids[i % len(self.net.node_ids)]
+        sent = time.monotonic()
+
+        def callback(resp):
+            latency = time.monotonic() - sent
+            with self._lock:
+                self._pending.discard(i)
+                if resp["type"] == "error":
+                    self.errors[resp["code"]] += 1
+                    return
+                self.latencies.append(latency)
+            self.workload.ok(req, resp)
+
+        with self._lock:
+            self._pending.add(i)
+        self.sent += 1
+        self.net.rpc(client, node_id, req, callback)
+
+    def timeouts(self):
+        return len(self._pending)
+
+
+parser = argparse.ArgumentParser(description="Benchmark of Maelstrom servers")
+parser.add_argument("-w", "--workload", required=True, choices=list(WORKLOADS))
+parser.add_argument("-n", "--nodes", type=int, default=3)
+parser.add_argument("--rate", type=float, default=100,
+                    help="Requests per second sent to the nodes")
+parser.add_argument("--duration", type=float, default=10,
+                    help="Time in seconds to send the requests for")
+parser.add_argument("--clients", type=int, default=10)
+parser.add_argument("--max-pending", type=int, default=1000,
+                    help="Skip requests while this many requests are pending")
+parser.add_argument("--timeout", type=float, default=5,
+                    help="Time in seconds to wait for pending requests")
+parser.add_argument("--latency", type=float, default=0,
+                    help="Network latency in milliseconds")
+parser.add_argument("--jitter", type=float, default=0,
+                    help="Max. random latency in milliseconds added to "
+                         "--latency")
+parser.add_argument("--loss", type=float, default=0,
+                    help="Probability that message between nodes is lost")
+parser.add_argument("--partition-interval", type=float, default=None,
+                    help="Partition and heal the network every N seconds")
+parser.add_argument("--settle", type=float, default=1,
+                    help="Time in seconds for nodes to converge before the "
+                         "final check")
+parser.add_argument("--json", action="store_true",
+                    help="Print the results as JSON")
+parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                    help="Arguments of maelstrom_server after --")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    server_args = args.server_args
+    if server_args[:1] == ["--"]:
+        server_args = server_args[1:]
+
+    net = Network(args.workload, args.nodes, server_args,
+                  args.latency / 1000, args.jitter / 1000, args.loss)
+    workload = WORKLOADS[args.workload]()
+    net.start()
+    try:
+        workload.setup(net)
+        nemesis = None
+        if args.partition_interval:
+            nemesis = Nemesis(net, args.partition_interval)
+            nemesis.start()
+        bench = Bench(net, workload, args.rate, args.duration, args.clients,
+                      args.max_pending, args.timeout)
+        elapsed = bench.run()
+        if nemesis:
+            nemesis.stop()
+        net_stats = dict(net.stats)
+
+        time.sleep(args.settle)
+        check = workload.check(net)
+        crashed = net.crashed()
+    finally:
+        net.stop()
+
+    ok = len(bench.latencies)
+    results = {
+        "workload": args.workload,
+        "nodes": args.nodes,
+        "sent": bench.sent,
+        "ok": ok,
+        "errors": dict(bench.errors),
+        "timeouts": bench.timeouts(),
+        "skipped": bench.skipped,
+        "throughput": ok / elapsed,
+        "latency_p50_ms": percentile(bench.latencies, 50) * 1000,
+        "latency_p99_ms": percentile(bench.latencies, 99) * 1000,
+        "latency_max_ms": max(bench.latencies, default=0) * 1000,
+        "msgs_per_op": net_stats["node_msgs"] / max(1, ok),
+        "service_msgs_per_op": net_stats["service_msgs"] / max(1, ok),
+        "dropped": net_stats["dropped"],
+        "check": check,
+        "crashed": crashed,
+    }
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            if isinstance(value, float):
+                value = "{:.2f}".format(value)
+            print("{:<20} {}".format(key, value))
+    for node_id in crashed:
+        print("\n{} crashed:".format(node_id))
+        print("\n".join(net.logs(node_id)))
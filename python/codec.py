@@ -0,0 +1,75 @@
+# Use the fastest JSON library available and fall back to the standard `json`
+# module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+import json
+
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+if orjson:
+    NAME = "orjson"
+    decode = orjson.loads
+
+    def encode(obj):
+        return orjson.dumps(obj)
+
+    def encode_line(obj):
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+elif ujson:
+    NAME = "ujson"
+    decode = ujson.loads
+
+    def encode(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode()
+
+    def encode_line(obj):
+        return (ujson.dumps(obj, ensure_ascii=False) + "\n").encode()
+
+else:
+    NAME = "json"
+    decode = json.loads
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def encode(obj):
+        return _encoder.encode(obj).encode()
+
+    def encode_line(obj):
+        return (_encoder.encode(obj) + "\n").encode()
+
+
+def read_lines(stream, chunk_size=READ_CHUNK_SIZE):
+    """
+    Read binary stream in large chunks and yield the lines as bytes, without
+    the trailing new line. The lines are never decoded into `str`, all the
+    codecs can parse bytes directly.
+    """
+    rest = b""
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            break
+        if rest:
+            chunk = rest + chunk
+
+        start = 0
+        end = chunk.find(b"\n")
+        while end >= 0:
+            if end > start:
+                yield chunk[start:end]
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        rest = chunk[start:]
+
+    if rest.strip():
+        yield rest
@@ -13,8 +13,8 @@ class MaelstromError(Exception):
     def to_dict(self):
         return {
             "type": "error",
-            "number": self.err_no,
-            "reason": self.msg,
+            "code": self.err_no,
+            "text": self.msg,
         }
 
     def to_json(self):
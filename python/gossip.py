@@ -0,0 +1,138 @@
+import random
+import threading
+import zlib
+
+from collections import deque
+
+import codec
+
+
+class Outbox:
+    """
+    Items which have to be delivered to a single peer. All pending items are
+    sent as one batch, which is acknowledged as a unit. Until the peer
+    acknowledges the batch, it's re-sent with exponential backoff.
+
+    Items are key-value pairs. When a key is put again with a new value, the
+    ack of the batch with the old value doesn't remove it. Plain values, e.g.
+    elements of a set, are stored as items with the same key and value.
+
+    Initial backoff adapts to the round trip time of the peer, so that the
+    batch isn't re-sent before the ack can arrive.
+    """
+    # Weight of the newest sample in exponentially weighted moving average.
+    ALPHA = 0.2
+
+    def __init__(self, min_backoff=0.2, max_backoff=5, backoff_floor=0.05):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff_floor = backoff_floor
+        self.rtt = None
+        self.attempts = 0
+        self._next_attempt = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, values):
+        with self._lock:
+            for value in values:
+                self._pending[value] = value
+
+    def put(self, items):
+        with self._lock:
+            self._pending.update(items)
+
+    def batch(self, now):
+        """
+        Returns dict of items to send to the peer, or `None` if there's
+        nothing to send or the backoff since the last attempt hasn't elapsed
+        yet.
+        """
+        with self._lock:
+            if not self._pending or now < self._next_attempt:
+                return None
+            backoff = min(
+                self.max_backoff, self.min_backoff * 2 ** self.attempts)
+            # Jitter prevents retries of all the nodes from being aligned.
+            self._next_attempt = now + backoff * random.uniform(0.5, 1)
+            self.attempts += 1
+            return dict(self._pending)
+
+    def ack(self, batch, rtt=None):
+        with self._lock:
+            for key, value in batch.items():
+                if key in self._pending and self._pending[key] == value:
+                    del self._pending[key]
+            self.attempts = 0
+            self._next_attempt = 0
+            if rtt is not None:
+                self._update_rtt(rtt)
+
+    def _update_rtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.ALPHA * (rtt - self.rtt)
+        self.min_backoff = min(
+            self.max_backoff, max(self.backoff_floor, 2 * self.rtt))
+
+
+class Digest:
+    """
+    Summary of a grow-only set, which allows to find out cheaply which parts
+    of the set differ between two nodes. Values are split into `buckets`
+    by their hash and each bucket is summarized by sum of the hashes of its
+    values. The digest is updated incrementally as the values are added.
+
+    Values enter the digest only `delay` seconds after they are added, once
+    `settle()` is called. Values which are still being replicated would make
+    the buckets of otherwise equal replicas differ, and the whole buckets
+    would be exchanged. Values of each bucket are indexed, so they are found
+    without hashing the whole set.
+    """
+
+    def __init__(self, buckets=64, delay=5):
+        self.buckets = buckets
+        self.delay = delay
+        self.sums = [0] * buckets
+        self._values = [[] for _ in range(buckets)]
+        self._recent = deque()
+
+    @staticmethod
+    def hash(value):
+        # Built-in hash() is randomized per process, use hash of the encoded
+        # value, which is the same on all the nodes.
+        return zlib.crc32(codec.encode(value))
+
+    def add(self, value, now):
+        self._recent.append((now, value))
+
+    def settle(self, now):
+        """
+        Add the values older than `delay` to their buckets.
+        """
+        deadline = now - self.delay
+        while self._recent and self._recent[0][0] <= deadline:
+            _, value = self._recent.popleft()
+            h = self.hash(value)
+            i = h % self.buckets
+            self.sums[i] = (self.sums[i] + h) % 2**32
+            self._values[i].append(value)
+
+    def values(self, buckets):
+        """
+        Returns values of the buckets, which are already in the digest.
+        """
+        return [value for i in buckets for value in self._values[i]]
+
+    def diff(self, other_sums):
+        """
+        Returns buckets, which differ from the other digest.
+        """
+        return [
+            i for i, (a, b) in enumerate(zip(self.sums, other_sums))
+            if a != b
+        ]
@@ -0,0 +1,182 @@
+import bisect
+import heapq
+import itertools
+
+from array import array
+
+import codec
+
+MIN_INT = -2 ** 63
+MAX_INT = 2 ** 63 - 1
+SUM_MASK = 2 ** 64 - 1
+
+
+class Run:
+    """
+    Immutable sorted array of 64-bit integers. Its JSON encoding and prefix
+    sums are computed only when needed and then cached.
+    """
+    __slots__ = ("values", "_encoded", "_sums")
+
+    def __init__(self, values):
+        self.values = values
+        self._encoded = None
+        self._sums = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def encoded(self):
+        """
+        Values encoded as JSON list without the brackets.
+        """
+        if self._encoded is None:
+            self._encoded = codec.encode(self.values.tolist())[1:-1]
+        return self._encoded
+
+    def range(self, lo, hi):
+        return (bisect.bisect_left(self.values, lo),
+                bisect.bisect_left(self.values, hi))
+
+    def range_sum(self, start, end):
+        if self._sums is None:
+            self._sums = array("Q", itertools.accumulate(
+                self.values, lambda a, b: (a + b) & SUM_MASK, initial=0))
+        return (self._sums[end] - self._sums[start]) & SUM_MASK
+
+
+class IntSet:
+    """
+    Compact set of integers. Values are stored in sorted runs of machine
+    integers, which take 8 bytes per value instead of ~60 bytes of `set`.
+    New values go to a small insert buffer, which is turned into a new run
+    once it's full. Runs of similar size are merged, so there are only
+    O(log n) runs and each value is merged O(log n) times.
+
+    Runs never change once created, so `snapshot()` is cheap and the encoded
+    runs are reused by the next snapshots. Values which don't fit 64-bit
+    integer are kept in a plain set.
+
+    The set is not thread safe, the callers have to synchronize the access.
+    """
+    BUFFER_SIZE = 1024
+
+    def __init__(self, values=()):
+        self._runs = []
+        self._buffer = set()
+        self._other = set()
+        self._len = 0
+        self.update(values)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for run in self._runs:
+            yield from run.values
+        yield from self._buffer
+        yield from self._other
+
+    def __contains__(self, value):
+        if not _fits(value):
+            return value in self._other
+        if value in self._buffer:
+            return True
+        # Largest runs are the first, search the smaller, recent ones first.
+        for run in reversed(self._runs):
+            values = run.values
+            i = bisect.bisect_left(values, value)
+            if i < len(values) and values[i] == value:
+                return True
+        return False
+
+    def add(self, value):
+        """
+        Returns `True` if the value wasn't in the set yet.
+        """
+        if value in self:
+            return False
+        if _fits(value):
+            self._buffer.add(value)
+            if len(self._buffer) >= self.BUFFER_SIZE:
+                self._flush()
+        else:
+            self._other.add(value)
+        self._len += 1
+        return True
+
+    def update(self, values):
+        """
+        Returns list of values, which weren't in the set yet.
+        """
+        return [value for value in values if self.add(value)]
+
+    def _flush(self):
+        self._runs.append(Run(array("q", sorted(self._buffer))))
+        self._buffer = set()
+        while (len(self._runs) > 1 and
+               len(self._runs[-2]) <= 2 * len(self._runs[-1])):
+            b = self._runs.pop()
+            a = self._runs.pop()
+            # Runs are disjoint, so merge doesn't have to drop duplicates.
+            self._runs.append(
+                Run(array("q", heapq.merge(a.values, b.values))))
+
+    def snapshot(self):
+        """
+        Returns immutable copy of the set, which can be encoded by
+        `encode()` without holding any lock.
+        """
+        runs = list(self._runs)
+        if self._buffer:
+            runs.append(Run(array("q", sorted(self._buffer))))
+        return runs, frozenset(self._other)
+
+    def range_digest(self, bounds):
+        """
+        Summary of the ranges `[bounds[i], bounds[i + 1])` given by sorted
+        `bounds`, as list of (count, sum) pairs. Replicas of a grow-only set
+        can compare the digests and exchange only the values from the ranges
+        which differ, see `values_in()`. Counts take O(log n) per range, sums
+        are computed once per run.
+        """
+        runs, _ = self.snapshot()
+        digest = []
+        for lo, hi in zip(bounds, bounds[1:]):
+            count = 0
+            total = 0
+            for run in runs:
+                start, end = run.range(lo, hi)
+                count += end - start
+                total = (total + run.range_sum(start, end)) & SUM_MASK
+            digest.append((count, total))
+        return digest
+
+    def values_in(self, lo, hi):
+        """
+        Returns sorted values from range `[lo, hi)`.
+        """
+        runs, _ = self.snapshot()
+        values = []
+        for run in runs:
+            start, end = run.range(lo, hi)
+            values.extend(run.values[start:end])
+        values.sort()
+        return values
+
+
+def encode(snapshot):
+    """
+    Encode snapshot of the set as JSON list. Only the runs created since the
+    previous snapshot are actually encoded.
+    """
+    runs, other = snapshot
+    parts = [run.encoded() for run in runs if len(run)]
+    if other:
+        parts.append(codec.encode(list(other))[1:-1])
+    return b"[" + b",".join(parts) + b"]"
+
+
+def _fits(value):
+    # bool is a subclass of int, but it's encoded differently.
+    return type(value) is int and MIN_INT <= value <= MAX_INT
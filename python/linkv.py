@@ -0,0 +1,58 @@
+import threading
+
+import codec
+from errors import (
+    KeyDoesnExistError,
+    MaelstromError,
+    NotSupportedError,
+    PreconditionFailedError,
+)
+
+
+class LinKv:
+    """
+    In-memory stand-in of Maelstrom lin-kv service. All the operations are
+    serialized by a single lock, which makes them trivially linearizable.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.ops = 0
+
+    def handle(self, body):
+        """
+        Returns body of the reply to the request `body`.
+        """
+        try:
+            resp = self._apply(body)
+        except MaelstromError as e:
+            resp = {"type": "error", "code": e.err_no, "text": e.msg}
+        resp["in_reply_to"] = body["msg_id"]
+        return resp
+
+    def _apply(self, body):
+        # Keys can be any JSON value and e.g. 1 and "1" are different keys.
+        key = codec.encode(body.get("key"))
+        with self._lock:
+            self.ops += 1
+            if body["type"] == "read":
+                if key not in self._data:
+                    raise KeyDoesnExistError("Key doesn't exist")
+                return {"type": "read_ok", "value": self._data[key]}
+
+            if body["type"] == "write":
+                self._data[key] = body["value"]
+                return {"type": "write_ok"}
+
+            if body["type"] == "cas":
+                if key not in self._data:
+                    if not body.get("create_if_not_exists"):
+                        raise KeyDoesnExistError("Key doesn't exist")
+                elif self._data[key] != body["from"]:
+                    raise PreconditionFailedError(
+                        "Current value doesn't match")
+                self._data[key] = body["to"]
+                return {"type": "cas_ok"}
+
+        raise NotSupportedError("Unsupported operation")
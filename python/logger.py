@@ -0,0 +1,101 @@
+import itertools
+import json
+import queue
+import sys
+import threading
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+    "debug": DEBUG,
+    "info": INFO,
+    "warning": WARNING,
+    "error": ERROR,
+}
+
+
+class Logger:
+    """
+    Logger writing to stderr from a background thread. Messages are
+    formatted only when their level is enabled and the formatting is done by
+    the background thread, so the arguments must not be modified after they
+    are logged. Messages logged with `sampled=True` are logged only once per
+    `sample_rate` calls.
+    """
+
+    def __init__(self, level=INFO, sample_rate=1, stream=None):
+        self.level = level
+        self.sample_rate = sample_rate
+        self.stream = stream or sys.stderr
+        self._sample_counter = itertools.count()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, *args, sampled=False):
+        if level < self.level:
+            return
+        if sampled and next(self._sample_counter) % self.sample_rate:
+            return
+        self._queue.put((msg, args))
+
+    def debug(self, msg, *args, sampled=False):
+        self.log(DEBUG, msg, *args, sampled=sampled)
+
+    def info(self, msg, *args, sampled=False):
+        self.log(INFO, msg, *args, sampled=sampled)
+
+    def warning(self, msg, *args, sampled=False):
+        self.log(WARNING, msg, *args, sampled=sampled)
+
+    def error(self, msg, *args, sampled=False):
+        self.log(ERROR, msg, *args, sampled=sampled)
+
+    def flush(self):
+        done = threading.Event()
+        self._queue.put((None, done))
+        done.wait()
+
+    def _drain(self):
+        while True:
+            lines = []
+            item = self._queue.get()
+            while True:
+                msg, args = item
+                if msg is None:
+                    # Flush marker.
+                    self._write(lines)
+                    lines = []
+                    args.set()
+                else:
+                    lines.append(self._format(msg, args))
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write(lines)
+
+    def _format(self, msg, args):
+        if args:
+            try:
+                msg = msg.format(*args)
+            except Exception as e:
+                msg = "Unable to format log message {!r}: {!r}".format(msg, e)
+        return json.dumps(msg) + "\n"
+
+    def _write(self, lines):
+        if lines:
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except Exception:
+                # There's nowhere to report the error, e.g. once stderr is
+                # closed, but the thread must keep setting flush markers.
+                pass
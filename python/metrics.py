@@ -0,0 +1,163 @@
+import itertools
+import math
+import threading
+
+from collections import Counter
+
+
+class Histogram:
+    """
+    Histogram of durations in seconds with exponential buckets. Bucket `i`
+    counts values up to `MIN_VALUE * 2**i`, so the percentiles are
+    approximate, but recording a value is cheap and takes constant memory.
+    """
+    MIN_VALUE = 1e-5
+    BUCKETS = 24
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        if value <= self.MIN_VALUE:
+            i = 0
+        else:
+            i = min(self.BUCKETS - 1,
+                    math.ceil(math.log2(value / self.MIN_VALUE)))
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        rank = math.ceil(p / 100 * self.count)
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.max, self.MIN_VALUE * 2 ** i)
+        return self.max
+
+    def to_dict(self):
+        # Durations are reported in milliseconds.
+        return {
+            "count": self.count,
+            "mean": round(self.total / max(1, self.count) * 1000, 3),
+            "p50": round(self.percentile(50) * 1000, 3),
+            "p99": round(self.percentile(99) * 1000, 3),
+            "max": round(self.max * 1000, 3),
+        }
+
+
+class _Shard:
+    """
+    Counters and histograms updated by a subset of the threads. The lock is
+    contended only by the threads sharing the shard and by the snapshot.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of the node. Counters and histograms are
+    updated by the node as the messages are processed, gauges are functions
+    evaluated only when the snapshot is taken. Summary of the metrics is
+    logged every `summary_interval` seconds, 0 disables the summary.
+
+    Every thread is assigned one of `SHARDS` shards, so the handler threads
+    don't contend for a single lock. Shards are merged by `snapshot()`.
+    """
+    SHARDS = 16
+
+    def __init__(self, summary_interval=0):
+        self.summary_interval = summary_interval
+        self._shards = [_Shard() for _ in range(self.SHARDS)]
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+        self._gauges = {}
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            # Threads of the thread runtime are short-lived, so they are
+            # assigned the shards round-robin instead of one per thread.
+            i = next(self._next_shard) % self.SHARDS
+            shard = self._local.shard = self._shards[i]
+        return shard
+
+    def count(self, name, n=1):
+        shard = self._shard()
+        with shard.lock:
+            shard.counters[name] += n
+
+    def message(self, direction, msg_type, size):
+        """
+        Count message sent or received, `direction` is "sent" or "recv".
+        """
+        shard = self._shard()
+        with shard.lock:
+            shard.counters["{}.{}".format(direction, msg_type)] += 1
+            shard.counters["{}.bytes".format(direction)] += size
+
+    def observe(self, name, value):
+        shard = self._shard()
+        with shard.lock:
+            histogram = shard.histograms.get(name)
+            if histogram is None:
+                histogram = shard.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        counters = Counter()
+        histograms = {}
+        for shard in self._shards:
+            with shard.lock:
+                counters.update(shard.counters)
+                for name, histogram in shard.histograms.items():
+                    merged = histograms.get(name)
+                    if merged is None:
+                        merged = histograms[name] = Histogram()
+                    merged.merge(histogram)
+        return {
+            "counters": dict(counters),
+            "histograms": {
+                name: histogram.to_dict()
+                for name, histogram in histograms.items()
+            },
+            "gauges": {name: fn() for name, fn in self._gauges.items()},
+        }
+
+    def summary(self):
+        """
+        Compact single line version of the snapshot.
+        """
+        snapshot = self.snapshot()
+        parts = [
+            "{}={}".format(name, value)
+            for name, value in sorted(snapshot["gauges"].items())
+        ]
+        parts.extend(
+            "{}={}".format(name, value)
+            for name, value in sorted(snapshot["counters"].items())
+        )
+        parts.extend(
+            "{}=p50:{p50}ms/p99:{p99}ms/n:{count}".format(name, **histogram)
+            for name, histogram in sorted(snapshot["histograms"].items())
+        )
+        return " ".join(parts)
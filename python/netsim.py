@@ -0,0 +1,194 @@
+import itertools
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from collections import deque
+
+import codec
+from linkv import LinKv
+from logger import Logger
+from scheduler import Scheduler
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "maelstrom_server")
+
+
+class Network:
+    """
+    Local stand-in of Maelstrom network. Spawns `maelstrom_server` process
+    for each node and routes the messages between the nodes, lin-kv service
+    and the clients.
+
+    Messages are delivered after `latency` plus random `jitter` seconds, so
+    they can be reordered. Messages between the nodes are lost with
+    probability `loss` or when the nodes are partitioned. Clients and
+    lin-kv can always reach all the nodes.
+    """
+    SERVICES = ("lin-kv",)
+    # Number of stderr lines kept for each node.
+    LOG_LINES = 100
+
+    def __init__(self, workload, nodes=3, server_args=(), latency=0,
+                 jitter=0, loss=0):
+        self.workload = workload
+        self.node_ids = ["n{}".format(i) for i in range(1, nodes + 1)]
+        self.server_args = list(server_args)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.lin_kv = LinKv()
+        self.stats = {
+            "node_msgs": 0,
+            "dropped": 0,
+            "service_msgs": 0,
+            "client_msgs": 0,
+        }
+        self._stats_lock = threading.Lock()
+        self._blocked = frozenset()
+        self._procs = {}
+        self._inboxes = {}
+        self._logs = {}
+        self._msg_ids = itertools.count(1)
+        self._callbacks = {}
+        self._scheduler = Scheduler()
+
+    def start(self, timeout=10):
+        """
+        Spawns the nodes and waits until all of them are initialized.
+        """
+        self._scheduler.start(lambda fn: fn(), Logger())
+        for node_id in self.node_ids:
+            proc = subprocess.Popen(
+                [sys.executable, SERVER, "-w", self.workload,
+                 *self.server_args],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            self._procs[node_id] = proc
+            self._inboxes[node_id] = queue.Queue()
+            self._logs[node_id] = deque(maxlen=self.LOG_LINES)
+            for target in (self._read, self._write, self._read_log):
+                threading.Thread(
+                    target=target, args=(node_id,), daemon=True).start()
+
+        done = threading.Semaphore(0)
+        for node_id in self.node_ids:
+            body = {
+                "type": "init",
+                "node_id": node_id,
+                "node_ids": self.node_ids,
+            }
+            self.rpc("c0", node_id, body, lambda resp: done.release())
+        deadline = time.monotonic() + timeout
+        for node_id in self.node_ids:
+            if not done.acquire(timeout=max(0, deadline - time.monotonic())):
+                raise Exception("Nodes not initialized in {}s".format(timeout))
+
+    def stop(self):
+        for proc in self._procs.values():
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        for proc in self._procs.values():
+            try:
+                proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def rpc(self, client_id, dest, body, callback):
+        """
+        Sends request from the client to the node `dest`. `callback` is
+        called with the reply body from the network thread, so it must not
+        block.
+        """
+        msg_id = next(self._msg_ids)
+        self._callbacks[msg_id] = callback
+        msg = {
+            "src": client_id,
+            "dest": dest,
+            "body": {**body, "msg_id": msg_id},
+        }
+        self._deliver(dest, codec.encode_line(msg))
+        return msg_id
+
+    def partition(self, groups):
+        """
+        Splits the nodes into `groups`, nodes in different groups can't
+        talk to each other.
+        """
+        self._blocked = frozenset(
+            (a, b)
+            for group in groups for a in group
+            for other in groups if other is not group for b in other)
+
+    def heal(self):
+        self._blocked = frozenset()
+
+    def logs(self, node_id):
+        return list(self._logs[node_id])
+
+    def crashed(self):
+        return [node_id for node_id, proc in self._procs.items()
+                if proc.poll() not in (None, 0)]
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def _delay(self):
+        return self.latency + random.uniform(0, self.jitter)
+
+    def _deliver(self, dest, line):
+        inbox = self._inboxes[dest]
+        self._scheduler.call_later(self._delay(), lambda: inbox.put(line))
+
+    def _read(self, node_id):
+        for line in self._procs[node_id].stdout:
+            msg = codec.decode(line)
+            dest = msg["dest"]
+            if dest in self._procs:
+                self._count("node_msgs")
+                if ((node_id, dest) in self._blocked or
+                        random.random() < self.loss):
+                    self._count("dropped")
+                    continue
+                self._deliver(dest, line)
+            elif dest in self.SERVICES:
+                self._count("service_msgs")
+                resp = {
+                    "src": dest,
+                    "dest": node_id,
+                    "body": self.lin_kv.handle(msg["body"]),
+                }
+                self._deliver(node_id, codec.encode_line(resp))
+            else:
+                self._count("client_msgs")
+                callback = self._callbacks.pop(
+                    msg["body"].get("in_reply_to"), None)
+                if callback:
+                    self._scheduler.call_later(
+                        self._delay(), lambda c=callback, b=msg["body"]: c(b))
+
+    def _write(self, node_id):
+        stream = self._procs[node_id].stdin
+        inbox = self._inboxes[node_id]
+        while True:
+            lines = [inbox.get()]
+            # Write out everything what's already waiting at once.
+            while not inbox.empty():
+                lines.append(inbox.get_nowait())
+            try:
+                stream.write(b"".join(lines))
+                stream.flush()
+            except (OSError, ValueError):
+                return
+
+    def _read_log(self, node_id):
+        for line in self._procs[node_id].stderr:
+            self._logs[node_id].append(line.decode(errors="replace").rstrip())
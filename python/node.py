@@ -1,100 +1,376 @@
-import json
+import asyncio
+import functools
+import itertools
 import sys
 import threading
 import time
 
-from transfer_types import ServiceRequest
+from collections import deque
+from concurrent.futures import Future
+
+import codec
+from errors import TimeoutError
+from logger import Logger
+from metrics import Metrics
+from runtime import PRIORITY_CALLBACK
+from runtime import PRIORITY_CLIENT
+from runtime import PRIORITY_INTERNAL
+from runtime import ThreadRuntime
+from scheduler import Scheduler, TimerWheel
+from writer import BatchWriter
+
+
+class CallbackTable:
+    """
+    Callbacks waiting for the responses. Table is split into shards, each
+    guarded by its own lock, so that threads registering and taking the
+    callbacks don't contend on a single lock. Callback is taken by atomic
+    `pop()`, so it's never called twice.
+    """
+
+    def __init__(self, shards=16):
+        self._shards = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def _index(self, key):
+        return hash(key) % len(self._shards)
+
+    def put(self, key, callback):
+        i = self._index(key)
+        with self._locks[i]:
+            self._shards[i][key] = callback
+
+    def pop(self, key):
+        """
+        Remove and return callback registered under the key, or `None`.
+        """
+        i = self._index(key)
+        with self._locks[i]:
+            return self._shards[i].pop(key, None)
 
 
 class Node:
+    # Timeout of service requests and of the callbacks waiting for other
+    # nodes, in seconds.
+    RPC_TIMEOUT = 5
+    # Max. number of requests in flight to single service, the rest waits in
+    # a queue.
+    RPC_INFLIGHT_LIMIT = 256
+
     def __init__(self):
         self.node_id = None
         self.node_ids = None
-        self.msg_id = 0
-        self._lock = threading.RLock()
-        self._log_lock = threading.RLock()
+        # next() on itertools.count is atomic, so msg IDs are allocated
+        # without a lock.
+        self._msg_ids = itertools.count(1)
         self._handlers = {
-            "init": self.init_handler,
+            "init": self._timed("init", self.init_handler),
+            "stats": self._timed("stats", self.stats_handler),
+        }
+        # Node cannot do anything useful before it's initialized. Stats are
+        # needed the most when the node is overloaded.
+        self._priorities = {
+            "init": PRIORITY_CALLBACK,
+            "stats": PRIORITY_CALLBACK,
         }
-        self._callbacks = {}
+        self._nonblocking = {"stats"}
+        self._coroutines = {}
+        self._callbacks = CallbackTable()
         self._periodic_tasks = []
+        self._runtime = ThreadRuntime()
+        self.scheduler = Scheduler()
+        self._rpc_lock = threading.Lock()
+        self._rpc_inflight = {}
+        self._rpc_queues = {}
+        self._callback_timeouts = TimerWheel()
+        self._callback_sweeper = None
+        self._services = {}
+        self._writer = BatchWriter(sys.stdout.buffer)
+        self.logger = Logger()
+        self.metrics = Metrics()
+        self.profiler = None
 
-    def send(self, dest, body, callback=None, callback_id=None):
-        with self._lock:
-            self.msg_id += 1
-
-            if callback:
-                if callback_id:
-                    self._callbacks[callback_id] = callback
-                else:
-                    self._callbacks[self.msg_id] = callback
-
-            if "msg_id" not in body:
-                body["msg_id"] = self.msg_id
-
-            resp = {
-                "src": self.node_id,
-                "dest": dest,
-                "body": {
-                    **body,
-                },
-            }
-            self.log("{} -> {}: {}", self.node_id, dest, resp)
-            sys.stdout.write(json.dumps(resp) + "\n")
-            sys.stdout.flush()
-
-    def reply(self, req, resp_body):
+    def send(self, dest, body, callback=None, callback_id=None, raw=None,
+             timeout=None):
+        """
+        Send message to `dest`. `raw` are optional fields of the body, which
+        are already encoded, e.g. cached `Snapshot.encoded()`. They are
+        appended to the encoded body as they are. With `timeout`, the
+        callback is dropped when there's no response within `timeout`
+        seconds, so that callbacks of lost messages don't pile up.
+        """
+        # Message is encoded by the calling thread and written out by the
+        # writer thread, there's no lock shared by all the senders.
+        msg_id = next(self._msg_ids)
+        if callback:
+            key = callback_id or msg_id
+            self._callbacks.put(key, callback)
+            if timeout:
+                self._callback_timeouts.add((key, None, None), timeout)
+
+        if "msg_id" not in body:
+            body["msg_id"] = msg_id
+
+        resp = {
+            "src": self.node_id,
+            "dest": dest,
+            "body": {
+                **body,
+            },
+        }
+        self.logger.debug(
+            "{} -> {}: {}", self.node_id, dest, resp, sampled=True)
+        frame = codec.encode_line(resp)
+        if raw:
+            # Encoded message ends with b"}}\n", closing the body and the
+            # message.
+            parts = [frame[:-3]]
+            for field, value in raw.items():
+                parts.append(b',"' + field.encode() + b'":' + value)
+            parts.append(b"}}\n")
+            frame = b"".join(parts)
+        self.metrics.message("sent", body["type"], len(frame))
+        self._writer.write(frame)
+        return msg_id
+
+    def reply(self, req, resp_body, raw=None):
         body = {
             **resp_body,
-            "msg_id": self.msg_id,
             "in_reply_to": req["body"]["msg_id"],
         }
-        self.send(req["src"], body)
+        self.send(req["src"], body, raw=raw)
 
     def service_rpc(self, dest, body):
-        srv_req = ServiceRequest()
-
-        def callback(req):
-            srv_req.set(req)
-
-        self.send(dest, body, callback)
-        srv_req.wait()
-        return srv_req.value
-
-    def run(self):
-        for line in sys.stdin:
-            req, body = parse_req(line)
-            try:
-                handler = self._get_handler(body)
-            except Exception:
-                pass
-            else:
-                t = threading.Thread(target=handler, args=(req,))
-                t.start()
+        """
+        Send request to a service. Returns `Future`, which resolves to the
+        response message, or fails with `TimeoutError` when there's no
+        response within `RPC_TIMEOUT`. Callers don't have to wait for the
+        response right away, so multiple requests can be in flight at the
+        same time.
+        """
+        future = Future()
+        if dest in self._services:
+            self._local_rpc(dest, body, future)
+            return future
+        with self._rpc_lock:
+            inflight = self._rpc_inflight.get(dest, 0)
+            if inflight >= self.RPC_INFLIGHT_LIMIT:
+                queue = self._rpc_queues.setdefault(dest, deque())
+                queue.append((body, future))
+                return future
+            self._rpc_inflight[dest] = inflight + 1
+        self._send_rpc(dest, body, future)
+        return future
+
+    def _send_rpc(self, dest, body, future):
+        sent = time.monotonic()
+
+        def callback(resp):
+            self.metrics.observe("rpc." + dest, time.monotonic() - sent)
+            self._rpc_done(dest)
+            future.set_result(resp)
+
+        msg_id = self.send(dest, body, callback)
+        self._callback_timeouts.add((msg_id, dest, future), self.RPC_TIMEOUT)
+
+    def register_service(self, name, service):
+        """
+        Handle requests to service `name` in-process by `service.handle()`
+        instead of sending them out, e.g. to run without Maelstrom.
+        """
+        self._services[name] = service
+
+    def _local_rpc(self, dest, body, future):
+        start = time.monotonic()
+        resp_body = self._services[dest].handle(
+            {**body, "msg_id": next(self._msg_ids)})
+        self.metrics.observe("rpc." + dest, time.monotonic() - start)
+        future.set_result({
+            "src": dest,
+            "dest": self.node_id,
+            "body": resp_body,
+        })
+
+    def _rpc_done(self, dest):
+        with self._rpc_lock:
+            queue = self._rpc_queues.get(dest)
+            if not queue:
+                self._rpc_inflight[dest] -= 1
+                return
+            body, future = queue.popleft()
+        self._send_rpc(dest, body, future)
+
+    def _expire_callbacks(self):
+        for key, dest, future in self._callback_timeouts.advance():
+            # Callback is removed, so that late response is ignored.
+            if self._callbacks.pop(key) is not None and future is not None:
+                self.metrics.count("rpc.timeouts")
+                self._rpc_done(dest)
+                future.set_exception(TimeoutError(
+                    "Timeout while waiting for response from {}".format(dest)))
+
+    async def async_service_rpc(self, dest, body):
+        """
+        Coroutine variant of `service_rpc()`, which waits for the response.
+        Can be used only by coroutine handlers running on `AsyncioRuntime`.
+        """
+        return await asyncio.wrap_future(self.service_rpc(dest, body))
+
+    def run(self, runtime=None, writer=None, logger=None, metrics=None,
+            profiler=None):
+        if runtime:
+            self._runtime = runtime
+        if writer:
+            self._writer = writer
+        if logger:
+            self.logger = logger
+        if metrics:
+            self.metrics = metrics
+        if profiler:
+            self.profiler = profiler
+            self.profiler.start()
+        self._register_gauges()
+        self._writer.start()
+        self.scheduler.start(self._runtime.execute, self.logger)
+        self._callback_sweeper = self.scheduler.every(
+            self._callback_timeouts.tick, self._expire_callbacks)
+        if self.metrics.summary_interval:
+            self.scheduler.every(
+                self.metrics.summary_interval, self._log_summary,
+                self.metrics.summary_interval)
+        try:
+            self._runtime.run(self)
+        finally:
+            self._writer.flush()
+            if self._writer.error is not None:
+                self.logger.error("Writing messages failed: {!r}",
+                                  self._writer.error)
+            self.dump_profile()
+            self.logger.flush()
+
+    def dump_profile(self):
+        if self.profiler:
+            self.profiler.dump(self.logger)
+
+    def _register_gauges(self):
+        self.metrics.gauge("callbacks", lambda: len(self._callbacks))
+        self.metrics.gauge("threads", threading.active_count)
+        self.metrics.gauge("queue", self._runtime.pending)
+        self.metrics.gauge("rpc.inflight", self._rpc_inflight_total)
+
+    def _rpc_inflight_total(self):
+        with self._rpc_lock:
+            return sum(self._rpc_inflight.values())
+
+    def _log_summary(self):
+        self.logger.info("Stats {}", self.metrics.summary())
+
+    def stats_handler(self, req):
+        self.reply(req, {
+            "type": "stats_ok",
+            "stats": self.metrics.snapshot(),
+        })
+
+    def _timed(self, req_type, handler):
+        """
+        Wrap the handler to record its latency, and its CPU time when
+        profiling.
+        """
+        name = "handler." + req_type
+        if asyncio.iscoroutinefunction(handler):
+            # Coroutines share the thread, so their CPU time isn't known.
+            @functools.wraps(handler)
+            async def timed(req):
+                start = time.monotonic()
+                try:
+                    return await handler(req)
+                finally:
+                    wall = time.monotonic() - start
+                    self.metrics.observe(name, wall)
+                    if self.profiler:
+                        self.profiler.record(req_type, wall, None)
+        else:
+            @functools.wraps(handler)
+            def timed(req):
+                start = time.monotonic()
+                cpu = time.thread_time()
+                try:
+                    return handler(req)
+                finally:
+                    wall = time.monotonic() - start
+                    self.metrics.observe(name, wall)
+                    if self.profiler:
+                        self.profiler.record(
+                            req_type, wall, time.thread_time() - cpu)
+        return timed
+
+    def handle_message(self, line):
+        req, body = parse_req(line)
+        self.metrics.message("recv", body["type"], len(line))
+        self.logger.debug(
+            "{} <- {}: {}", self.node_id, req["src"], req, sampled=True)
+        try:
+            handler, callback = self._get_handler(body)
+        except Exception:
+            pass
+        else:
+            self._runtime.dispatch(
+                handler, req, callback, self._priority(req, callback),
+                body["type"] not in self._nonblocking)
+
+    def _priority(self, req, callback):
+        if callback:
+            return PRIORITY_CALLBACK
+        req_type = req["body"]["type"]
+        if req_type in self._priorities:
+            return self._priorities[req_type]
+        if self.node_ids and req["src"] in self.node_ids:
+            return PRIORITY_INTERNAL
+        return PRIORITY_CLIENT
 
     def _get_handler(self, body):
         req_type = body["type"]
         callback_id = body.get("callback_id")
         msg_id = body.get("in_reply_to")
 
-        if callback_id and callback_id in self._callbacks:
-            handler = self._callbacks[callback_id]
-            del self._callbacks[callback_id]
-        elif msg_id and msg_id in self._callbacks:
-            handler = self._callbacks[msg_id]
-            del self._callbacks[msg_id]
-        else:
-            if req_type not in self._handlers:
-                raise Exception(
-                    "No handler for request type %r" % req_type)
-            handler = self._handlers[req_type]
+        handler = None
+        if callback_id:
+            handler = self._callbacks.pop(callback_id)
+        if handler is None and msg_id:
+            handler = self._callbacks.pop(msg_id)
+        if handler is not None:
+            return handler, True
 
-        return handler
+        if req_type not in self._handlers:
+            raise Exception(
+                "No handler for request type %r" % req_type)
+        if self._runtime.COROUTINES and req_type in self._coroutines:
+            return self._coroutines[req_type], False
+        return self._handlers[req_type], False
 
-    def register_handler(self, req_type, handler):
+    def register_handler(self, req_type, handler, priority=None,
+                         blocking=True, coroutine=None):
+        """
+        Register handler for given request type. `priority` is used only by
+        runtimes with a queue. By default, messages from other nodes of the
+        cluster take precedence over the client requests. Handlers which
+        never wait for other nodes or services should pass `blocking=False`,
+        `AsyncioRuntime` then runs them directly on the loop. `coroutine` is
+        optional coroutine variant of the handler, which is used instead by
+        runtimes running an event loop.
+        """
         if req_type in self._handlers:
             raise Exception("Handler for %r already registered" % req_type)
-        self._handlers[req_type] = handler
+        self._handlers[req_type] = self._timed(req_type, handler)
+        if coroutine is not None:
+            self._coroutines[req_type] = self._timed(req_type, coroutine)
+        if priority is not None:
+            self._priorities[req_type] = priority
+        if not blocking:
+            self._nonblocking.add(req_type)
 
     def post_init(self):
         pass
@@ -104,32 +380,24 @@ class Node:
         self.node_id = body["node_id"]
         self.node_ids = body["node_ids"]
 
+        # Node has to be fully initialized before it confirms the init,
+        # Maelstrom starts sending requests right after that.
+        self.post_init()
+        self.start_periodic_tasks()
         resp_body = {
             "type": "init_ok",
         }
         self.reply(req, resp_body)
-        self.start_periodic_tasks()
-        self.post_init()
 
     def start_periodic_tasks(self):
         for task in self._periodic_tasks:
-            t = threading.Thread(target=self._run_periodic_task, args=(task,))
-            t.start()
-
-    def _run_periodic_task(self, task):
-        while True:
-            task["f"]()
-            time.sleep(task["dt"])
+            self.scheduler.every(task["dt"], task["f"])
 
     def log(self, log_msg, *args):
-        if args:
-            log_msg = log_msg.format(*args)
-        with self._log_lock:
-            sys.stderr.write(json.dumps(log_msg) + "\n")
-            sys.stderr.flush()
+        self.logger.info(log_msg, *args)
 
 
 def parse_req(line):
-    req = json.loads(line)
+    req = codec.decode(line)
     body = req["body"]
     return req, body
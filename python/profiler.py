@@ -0,0 +1,95 @@
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+
+
+class Profiler:
+    """
+    Sampling profiler of all the threads of the process. Every `interval`
+    seconds, stacks of all the threads are taken and counted, so unlike
+    cProfile, it sees the handler threads and the overhead doesn't depend on
+    the number of function calls.
+
+    Stacks are dumped to `path` in collapsed format, one stack per line with
+    its number of samples, which can be turned into a flame graph by e.g.
+    flamegraph.pl or speedscope. Threads waiting, e.g. for a lock or lin-kv
+    response, are sampled as well, so the samples show wall time, not only
+    CPU time.
+
+    Node also reports wall and CPU time of the handlers, which is logged
+    together with the dump.
+    """
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._handlers = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, req_type, wall, cpu):
+        """
+        Record time spent by a handler. CPU time is `None` when it's not
+        known, e.g. for coroutine handlers sharing the thread.
+        """
+        with self._lock:
+            stats = self._handlers.get(req_type)
+            if stats is None:
+                stats = self._handlers[req_type] = [0, 0, 0]
+            stats[0] += 1
+            stats[1] += wall
+            if cpu is not None:
+                stats[2] += cpu
+
+    def dump(self, logger):
+        with self._lock:
+            stacks = list(self._stacks.items())
+            handlers = sorted(
+                self._handlers.items(), key=lambda item: -item[1][1])
+        tmp = "{}.tmp".format(self.path)
+        with open(tmp, "w") as f:
+            for stack, count in stacks:
+                f.write("{} {}\n".format(stack, count))
+        os.replace(tmp, self.path)
+
+        logger.info("Profile: {} samples written to {}",
+                    self.samples, self.path)
+        for req_type, (count, wall, cpu) in handlers:
+            logger.info(
+                "Profile: handler {} calls {} wall {:.3f}s cpu {:.3f}s",
+                req_type, count, wall, cpu)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            label = self._labels[code] = "{}:{}".format(module, code.co_name)
+        return label
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                labels.reverse()
+                stacks.append(";".join(labels))
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
@@ -0,0 +1,201 @@
+import asyncio
+import itertools
+import queue
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+from errors import TemporarilyUnavailableError
+
+
+# Lower number means higher priority.
+PRIORITY_CALLBACK = 0
+PRIORITY_INTERNAL = 1
+PRIORITY_CLIENT = 2
+
+
+class ThreadRuntime:
+    """
+    Original runtime, which starts a new thread for every incoming message.
+    """
+    # Runtime runs coroutine handlers.
+    COROUTINES = False
+
+    def __init__(self):
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def run(self, node):
+        for line in codec.read_lines(sys.stdin.buffer):
+            node.handle_message(line)
+
+    def dispatch(self, handler, req, callback=False,
+                 priority=PRIORITY_CLIENT, blocking=True):
+        with self._lock:
+            self._running += 1
+        t = threading.Thread(target=self._handle, args=(handler, req))
+        t.start()
+
+    def _handle(self, handler, req):
+        try:
+            handler(req)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def execute(self, fn):
+        fn()
+
+    def pending(self):
+        """
+        Number of messages waiting for a handler. Messages don't wait here,
+        so it's the number of running handler threads.
+        """
+        return self._running
+
+
+class PoolRuntime(ThreadRuntime):
+    """
+    Runtime which runs handlers on a fixed number of worker threads. Messages
+    wait in a bounded priority queue, messages from other nodes are processed
+    before new client requests. When the queue is full, the request is
+    rejected with `TemporarilyUnavailableError`.
+
+    Callbacks are run directly on the thread reading stdin. They only hand
+    over the response to the waiting party and running them in the pool could
+    deadlock once all the workers are blocked waiting for a response.
+    """
+
+    def __init__(self, workers=16, queue_size=1024):
+        super().__init__()
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = queue.PriorityQueue()
+        # Keeps FIFO order of messages with the same priority.
+        self._seq = itertools.count()
+        self._node = None
+
+    def run(self, node):
+        self._node = node
+        for _ in range(self.workers):
+            t = threading.Thread(target=self._work, daemon=True)
+            t.start()
+        super().run(node)
+
+    def dispatch(self, handler, req, callback=False,
+                 priority=PRIORITY_CLIENT, blocking=True):
+        if callback:
+            handler(req)
+            return
+
+        full = self._queue.qsize() >= self.queue_size
+        if full and priority != PRIORITY_CALLBACK:
+            self._reject(req)
+            return
+        self._queue.put((priority, next(self._seq), handler, req))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _reject(self, req):
+        if "msg_id" not in req["body"]:
+            return
+        err = TemporarilyUnavailableError(
+            "Node is overloaded, {} messages waiting".format(self.queue_size))
+        self._node.reply(req, err.to_dict())
+
+    def _work(self):
+        while True:
+            _, _, handler, req = self._queue.get()
+            try:
+                handler(req)
+            except Exception as e:
+                self._node.logger.error(
+                    "Handler {} failed: {!r}", handler.__name__, e)
+
+
+class AsyncioRuntime:
+    """
+    Runtime driven by asyncio event loop. Coroutine handlers run as tasks on
+    the loop. Callbacks, timers and handlers registered as non-blocking are
+    run directly on the loop, as they only update the local state and send
+    messages. Other plain handlers run in a bounded thread pool, so that
+    blocking calls like `Node.service_rpc()` still work.
+    """
+    COROUTINES = True
+    READ_LIMIT = 2 ** 24
+
+    def __init__(self, workers=None):
+        # Loop exists before it runs, the scheduler hands over the timers
+        # as soon as the node starts.
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=workers))
+        self._tasks = set()
+        # Handlers submitted to the thread pool and not finished yet.
+        self._jobs = 0
+        self._node = None
+
+    def run(self, node):
+        self._node = node
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main(node))
+        finally:
+            self.loop.close()
+
+    async def _main(self, node):
+
+        reader = asyncio.StreamReader(limit=self.READ_LIMIT)
+        protocol = asyncio.StreamReaderProtocol(reader)
+        await self.loop.connect_read_pipe(lambda: protocol, sys.stdin)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            node.handle_message(line)
+
+    def dispatch(self, handler, req, callback=False,
+                 priority=PRIORITY_CLIENT, blocking=True):
+        if asyncio.iscoroutinefunction(handler):
+            self._create_task(handler(req))
+        elif callback or not blocking:
+            handler(req)
+        else:
+            # Counted on the loop, so no lock is needed.
+            self._jobs += 1
+            job = self.loop.run_in_executor(None, handler, req)
+            job.add_done_callback(self._job_done)
+
+    def execute(self, fn):
+        """
+        Run function scheduled by `Scheduler` on the loop. Coroutine
+        functions are started as tasks.
+        """
+        if asyncio.iscoroutinefunction(fn):
+            self.loop.call_soon_threadsafe(self._create_task, fn())
+        else:
+            self.loop.call_soon_threadsafe(self._call, fn)
+
+    def _call(self, fn):
+        try:
+            fn()
+        except Exception as e:
+            self._node.logger.error("Timer {!r} failed: {!r}", fn, e)
+
+    def pending(self):
+        # Unlike the pool runtime, this includes the running handlers.
+        return len(self._tasks) + self._jobs
+
+    def _job_done(self, job):
+        self._jobs -= 1
+
+    def _create_task(self, coro):
+        # Keep reference to the task, otherwise it can be garbage collected
+        # before it finishes.
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
@@ -0,0 +1,214 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ("when", "fn", "cancelled")
+
+    def __init__(self, when, fn):
+        self.when = when
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class PeriodicTask:
+    """
+    Task run every `interval` seconds until cancelled. Interval can be
+    changed at any time, the change is applied after the next run.
+    """
+
+    def __init__(self, scheduler, interval, fn):
+        self.interval = interval
+        self._scheduler = scheduler
+        self._fn = fn
+        self._timer = None
+        self.cancelled = False
+
+    def start(self, delay=None):
+        self._timer = self._scheduler.call_later(
+            self.interval if delay is None else delay, self._run)
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+        if self._timer:
+            self._timer.cancel()
+
+    def _run(self):
+        if self.cancelled:
+            return
+        try:
+            self._fn()
+        finally:
+            if not self.cancelled:
+                self.start()
+
+
+class Scheduler:
+    """
+    Runs timers of the node from a single thread. Timers are ordered by
+    their deadline in a heap, cancelled timers are just skipped once they
+    expire. Timer functions are executed by the runtime, see
+    `Runtime.execute()`, and they must not block.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Breaks ties between timers with the same deadline.
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._execute = None
+        self._logger = None
+        self._thread = None
+
+    def start(self, execute, logger):
+        self._execute = execute
+        self._logger = logger
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def call_at(self, when, fn):
+        timer = Timer(when, fn)
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._seq), timer))
+            if self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def call_later(self, delay, fn):
+        return self.call_at(time.monotonic() + delay, fn)
+
+    def every(self, interval, fn, delay=0):
+        return PeriodicTask(self, interval, fn).start(delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        _, _, timer = heapq.heappop(self._heap)
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+
+            if timer.cancelled:
+                continue
+            try:
+                self._execute(timer.fn)
+            except Exception as e:
+                self._logger.error("Timer {!r} failed: {!r}", timer.fn, e)
+
+
+class DebouncedTask:
+    """
+    Runs `fn` once the state it processes gets dirty. The run is delayed by
+    the debounce window, so that changes made in quick succession are
+    processed together, but not more than `max_staleness` seconds after the
+    first change.
+
+    Debounce window adapts to the rate of changes. When the changes come more
+    often than the window, the window grows up to half of `max_staleness` to
+    batch more changes. When the changes are sparse, it shrinks down to
+    `min_debounce`, so that single changes are processed quickly.
+    """
+    # Weight of the newest sample in exponentially weighted moving average.
+    ALPHA = 0.2
+
+    def __init__(self, scheduler, fn, min_debounce=0.01, max_staleness=0.5):
+        self.min_debounce = min_debounce
+        self.max_staleness = max_staleness
+        self.debounce = min_debounce
+        self._scheduler = scheduler
+        self._fn = fn
+        self._lock = threading.Lock()
+        self._timer = None
+        self._first_dirty = None
+        self._last_dirty = None
+        self._avg_gap = None
+
+    def mark_dirty(self):
+        now = time.monotonic()
+        with self._lock:
+            self._adapt(now)
+            if self._first_dirty is None:
+                self._first_dirty = now
+            if self._timer is None:
+                self._timer = self._scheduler.call_at(
+                    now + self.debounce, self._run)
+
+    def cancel(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._first_dirty = None
+
+    def _adapt(self, now):
+        if self._last_dirty is not None:
+            gap = now - self._last_dirty
+            if self._avg_gap is None:
+                self._avg_gap = gap
+            else:
+                self._avg_gap += self.ALPHA * (gap - self._avg_gap)
+            if self._avg_gap < self.debounce:
+                self.debounce = min(self.debounce * 2, self.max_staleness / 2)
+            else:
+                self.debounce = max(self.debounce / 2, self.min_debounce)
+        self._last_dirty = now
+
+    def _run(self):
+        with self._lock:
+            if self._timer is None:
+                # Cancelled.
+                return
+            # Instead of re-scheduling the timer on every change, check if
+            # there was any change in the meantime and postpone the run.
+            due = min(self._last_dirty + self.debounce,
+                      self._first_dirty + self.max_staleness)
+            if time.monotonic() < due:
+                self._timer = self._scheduler.call_at(due, self._run)
+                return
+            self._timer = None
+            self._first_dirty = None
+        self._fn()
+
+
+class TimerWheel:
+    """
+    Cheap timeouts for large number of items, which mostly don't expire.
+    Items are put into slots by their deadline and `advance()` has to be
+    called every `tick` seconds to collect the expired ones. Adding an item
+    is O(1) and an item doesn't need to be removed when it's done, it's just
+    ignored once it expires. Timeouts are rounded up to whole ticks and
+    capped to `slots - 1` ticks.
+    """
+
+    def __init__(self, tick=0.1, slots=1024):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._current = 0
+        self._lock = threading.Lock()
+
+    def add(self, item, timeout):
+        ticks = min(max(1, math.ceil(timeout / self.tick)),
+                    len(self._slots) - 1)
+        with self._lock:
+            slot = (self._current + ticks) % len(self._slots)
+            self._slots[slot].append(item)
+
+    def advance(self):
+        """
+        Move the wheel by one tick and return items, which expired.
+        """
+        with self._lock:
+            self._current = (self._current + 1) % len(self._slots)
+            expired = self._slots[self._current]
+            self._slots[self._current] = []
+        return expired
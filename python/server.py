@@ -1,15 +1,33 @@
+import asyncio
+import os
+import random
 import threading
 import time
 
-from errors import MaelstromError
+from errors import AbortError, MaelstromError
+from gossip import Digest, Outbox
+import intset
+from intset import IntSet
 from node import Node
-from transfer_types import GCounter, TxnState, MonotonicId
+from scheduler import DebouncedTask
+from storage import Storage
+import topology
+from transfer_types import (
+    DbNode,
+    GCounter,
+    GSet,
+    MonotonicId,
+    PNCounter,
+    SnapshotCache,
+    Thunk,
+    TxnState,
+)
 
 
 class EchoServer(Node):
     def __init__(self):
         super().__init__()
-        self.register_handler("echo", self.echo_handler)
+        self.register_handler("echo", self.echo_handler, blocking=False)
 
     def echo_handler(self, req):
         body = req["body"]
@@ -21,272 +39,560 @@ class EchoServer(Node):
 
 
 class BroadcastServer(Node):
-    def __init__(self):
+    # How often unacknowledged messages are re-sent. New messages are sent
+    # right away, within the debounce window.
+    GOSSIP_INTERVAL = 0.1
+    MAX_STALENESS = 0.1
+    # Number of unacknowledged gossip attempts after which the neighbor is
+    # considered to be partitioned.
+    PARTITION_ATTEMPTS = 3
+
+    def __init__(self, topology="maelstrom", fanout=4):
+        """
+        `topology` determines the neighbors used for gossip. With `maelstrom`
+        the topology sent by Maelstrom is used as is, `tree` and `small-world`
+        compute own overlay with given `fanout`. In such case, topology sent
+        by Maelstrom is used as a fallback when a neighbor gets partitioned.
+        """
         super().__init__()
 
+        self.topology = topology
+        self.fanout = fanout
         self.neighbors = []
-        self.messages = set()
+        self._fallback = []
+        # Neighbors, which don't acknowledge gossip, while the fallback
+        # neighbors are used.
+        self._partitioned = set()
+        self.messages = IntSet()
         self.msg_lock = threading.RLock()
-
-        self.register_handler("topology", self.topology_handler)
-        self.register_handler("broadcast", self.broadcast_handler)
-        self.register_handler("read", self.read_handler)
+        self._snapshot = SnapshotCache(
+            self.msg_lock, self.messages.snapshot, intset.encode)
+        self._outboxes = {}
+        self._gossip_task = DebouncedTask(
+            self.scheduler, self._gossip, max_staleness=self.MAX_STALENESS)
+
+        self.register_handler(
+            "topology", self.topology_handler, blocking=False)
+        self.register_handler(
+            "broadcast", self.broadcast_handler, blocking=False)
+        self.register_handler("gossip", self.gossip_handler, blocking=False)
+        self.register_handler("read", self.read_handler, blocking=False)
+
+        self._periodic_tasks.append(
+            {"f": self._gossip, "dt": self.GOSSIP_INTERVAL})
 
     def topology_handler(self, req):
         body = req["body"]
-        self.neighbors = body["topology"][self.node_id]
+        given = body["topology"][self.node_id]
+        if self.topology == "tree":
+            self.neighbors = topology.tree(
+                self.node_ids, self.fanout)[self.node_id]
+        elif self.topology == "small-world":
+            self.neighbors = topology.small_world(
+                self.node_ids, self.fanout)[self.node_id]
+        else:
+            self.neighbors = given
+        self._fallback = [node for node in given if node not in self.neighbors]
+        self._partitioned = set()
+        self._outboxes = {node: Outbox() for node in self.neighbors}
+        self.log("Neighbors {}, fallback {}", self.neighbors, self._fallback)
         resp_body = {
             "type": "topology_ok",
         }
         self.reply(req, resp_body)
 
     def broadcast_handler(self, req):
+        self.reply(req, {"type": "broadcast_ok"})
+        self._add_messages([req["body"]["message"]], req["src"])
+
+    def gossip_handler(self, req):
         """
-        Handler implementing broadcast. Broadcast messages sent by nodes in
-        the cluster contain field `internal` set to `True`. It also contains
-        `broadcast_id`, which has similar purpose as `msg_id`, but to
-        distinguish it from `msg_id`, it's called `broadcast_id`.
-
-        Once node receives such message, it replies with `broadcast_ok`
-        message. This message also contains `callback_id` which determines
-        the callback function to be called by the sender once it receives
-        `broadcast_ok` message.
+        Handler of messages gossiped by the other nodes. Gossip message
+        contains all the messages not yet acknowledged by the receiver and
+        the receiver acknowledges all of them at once by `gossip_ok` reply.
         """
-        neighbors_ack = self.neighbors.copy()
-
-        if "internal" in req["body"]:
-            # Don't resend message back to the sender.
-            neighbors_ack.remove(req["src"])
-            self.send(req["src"], {
-                "type": "broadcast_ok",
-                "callback_id": "{}_{}".format(
-                    req["body"]["broadcast_id"], self.node_id)
-            })
-        else:
-            self.reply(req, {"type": "broadcast_ok"})
+        self._add_messages(req["body"]["messages"], req["src"])
+        self.reply(req, {"type": "gossip_ok"})
 
-        msg = req["body"]["message"]
-        new_msg = False
+    def _add_messages(self, msgs, src):
         with self.msg_lock:
-            if msg not in self.messages:
-                self.messages.add(msg)
-                new_msg = True
-
-        def broadcast_ack_handler(req):
-            """
-            Handler which removes sender from the list of nodes which haven't
-            accepted new broadcast message yet.
-            """
-            if req["body"]["type"] == "broadcast_ok":
-                neighbors_ack.remove(req["src"])
-
-        def broadcast_neighbors():
-            while neighbors_ack:
-                for node in neighbors_ack:
-                    self.send(
-                        node,
-                        broadcast_body,
-                        callback=broadcast_ack_handler,
-                        callback_id="{}_{}".format(broadcast_id, node)
-                    )
-                time.sleep(1)
-
-        if new_msg:
-            broadcast_id = req["body"].get("broadcast_id")
-            if broadcast_id is None:
-                # `broadcast_id` has similar function as msg_is in
-                # client-server communication.
-                broadcast_id = req["body"]["msg_id"]
-            broadcast_body = {
-                "type": "broadcast",
-                "message": msg,
-                "internal": True,
-                "broadcast_id": broadcast_id
-            }
-
-            # This has to be run in separate thread not to block event loop, as
-            # in case of network partition, this would block until the
-            # connection is re-established.
-            t = threading.Thread(target=broadcast_neighbors)
-            t.start()
-
-    def read_handler(self, req):
+            new_msgs = self.messages.update(msgs)
+            if new_msgs:
+                self._snapshot.invalidate()
+
+        if new_msgs:
+            # Don't send messages back to the sender.
+            for node, outbox in self._outboxes.items():
+                if node != src:
+                    outbox.add(new_msgs)
+            self._gossip_task.mark_dirty()
+
+    def _gossip(self):
+        now = time.monotonic()
+        for node, outbox in list(self._outboxes.items()):
+            batch = outbox.batch(now)
+            if batch:
+                self.send(
+                    node,
+                    {"type": "gossip", "messages": list(batch)},
+                    callback=self._gossip_ack_handler(
+                        node, outbox, batch, now),
+                    timeout=self.RPC_TIMEOUT)
+            if (outbox.attempts >= self.PARTITION_ATTEMPTS and
+                    node not in self._fallback and
+                    node not in self._partitioned):
+                self._activate_fallback(node)
+
+    def _activate_fallback(self, node):
+        """
+        Start gossiping also with the neighbors from the topology sent by
+        Maelstrom, so that the messages get around the partitioned node.
+        Fallback neighbors may miss any message, so they get all of them.
+        """
         with self.msg_lock:
-            resp_body = {
-                "type": "read_ok",
-                "messages": list(self.messages),
+            if not self._fallback:
+                return
+            self._partitioned.add(node)
+            if len(self._partitioned) > 1:
+                # Fallback neighbors are already used.
+                return
+            self.log("Node {} is partitioned, adding neighbors {}",
+                     node, self._fallback)
+            msgs = list(self.messages)
+            outboxes = dict(self._outboxes)
+            for fallback in self._fallback:
+                outbox = Outbox()
+                outbox.add(msgs)
+                outboxes[fallback] = outbox
+            self.neighbors = list(outboxes)
+            self._outboxes = outboxes
+        self._gossip_task.mark_dirty()
+
+    def _deactivate_fallback(self, node):
+        """
+        Stop gossiping with the fallback neighbors once all the partitioned
+        neighbors acknowledge gossip again. Messages they may still miss are
+        delivered by the regular neighbors.
+        """
+        with self.msg_lock:
+            if node not in self._partitioned:
+                return
+            self._partitioned.remove(node)
+            if self._partitioned:
+                return
+            self.log("Node {} is reachable, dropping neighbors {}",
+                     node, self._fallback)
+            outboxes = {
+                peer: outbox for peer, outbox in self._outboxes.items()
+                if peer not in self._fallback
             }
-            self.reply(req, resp_body)
+            self.neighbors = list(outboxes)
+            self._outboxes = outboxes
+
+    def _gossip_ack_handler(self, node, outbox, batch, sent):
+        def gossip_ack_handler(req):
+            if req["body"]["type"] == "gossip_ok":
+                outbox.ack(batch, time.monotonic() - sent)
+                if node in self._partitioned:
+                    self._deactivate_fallback(node)
+                if len(outbox):
+                    self._gossip_task.mark_dirty()
+        return gossip_ack_handler
 
-
-class GSetServer(Node):
-    def __init__(self):
+    def read_handler(self, req):
+        snapshot = self._snapshot.get()
+        self.reply(
+            req, {"type": "read_ok"}, raw={"messages": snapshot.encoded()})
+
+
+class CrdtServer(Node):
+    """
+    Base class of servers replicating a delta-state CRDT. Local updates are
+    collected as deltas, which are sent to every other node until it
+    acknowledges them.
+
+    Subclasses register handlers of their updates, e.g. `add`, and have to
+    call `_changed()` after each update to trigger the replication. Updates
+    made within the debounce window are replicated together, but not later
+    than `MAX_STALENESS` seconds after the first one. Idle node doesn't send
+    anything.
+
+    With `data_dir`, every change is also written to `Storage`, subclasses
+    have to log their local updates by `_log()`. Restarted node restores its
+    state from the storage and replicates only the new deltas.
+    """
+    # How often unacknowledged deltas are re-sent.
+    RETRY_INTERVAL = 0.2
+    MAX_STALENESS = 0.5
+    # How often the storage checks if the log should be compacted.
+    COMPACT_INTERVAL = 1
+
+    def __init__(self, crdt, data_dir=None):
         super().__init__()
 
-        self._set = set()
-        self.set_lock = threading.RLock()
+        self.crdt = crdt
+        self.storage = None
+        self._data_dir = data_dir
+        self.lock = threading.RLock()
+        self._snapshot = SnapshotCache(self.lock, self.crdt.value)
+        self._outboxes = {}
+        self._replication = DebouncedTask(
+            self.scheduler, self._replicate, max_staleness=self.MAX_STALENESS)
+
+        # With storage, every change is written to the log, which must not
+        # block the event loop.
+        self._durable = data_dir is not None
+        self.register_handler("read", self.read_handler, blocking=False)
+        self.register_handler(
+            "replicate", self.replicate_handler, blocking=self._durable)
 
-        self.register_handler("read", self.read_handler)
-        self.register_handler("add", self.add_handler)
-        self.register_handler("replicate", self.replicate_handler)
+        self._periodic_tasks.append(
+            {"f": self._replicate, "dt": self.RETRY_INTERVAL})
 
-        self._periodic_tasks.append({"f": self._replicate, "dt": 5})
+    def post_init(self):
+        self._outboxes = {
+            node: Outbox() for node in self.node_ids if node != self.node_id
+        }
+        if self._data_dir:
+            self._restore(
+                Storage(os.path.join(self._data_dir, self.node_id)))
+
+    def _restore(self, storage):
+        start = time.monotonic()
+        values = storage.load()
+        for value in values:
+            self._merge(value)
+        # Changes are logged only once the state is restored.
+        self.storage = storage
+        self._restored()
+        self.log("Restored {} records from {} in {:.3f}s",
+                 len(values), storage.path, time.monotonic() - start)
+        self._periodic_tasks.append(
+            {"f": self._compact, "dt": self.COMPACT_INTERVAL})
+
+    def _restored(self):
+        pass
+
+    def _log(self, value):
+        # Has to be called under the lock, together with the change.
+        if self.storage:
+            self.storage.append(value)
+
+    def _compact(self):
+        # Timers must not block, snapshot is written by its own thread.
+        if self.storage.needs_compaction():
+            threading.Thread(target=self._write_snapshot, daemon=True).start()
+
+    def _write_snapshot(self):
+        with self.lock:
+            if not self.storage.rotate():
+                return
+            state = self.crdt.to_json()
+        try:
+            self.storage.compact(state)
+        except Exception as e:
+            # Rotated log is kept, the next compaction includes it.
+            self.logger.error("Compaction of {} failed: {!r}",
+                              self.storage.path, e)
 
     def _replicate(self):
-        with self.set_lock:
-            values = list(self._set)
-
-        self.log("Replicating set {}", values)
-        for node in self.node_ids:
-            if node != self.node_id:
-                resp_body = {
-                    "type": "replicate",
-                    "value": values,
-                }
-                self.send(node, resp_body)
+        with self.lock:
+            delta = self.crdt.take_delta()
+        if delta:
+            for outbox in self._outboxes.values():
+                outbox.put(delta)
+
+        now = time.monotonic()
+        for node, outbox in list(self._outboxes.items()):
+            batch = outbox.batch(now)
+            if batch:
+                value = self.crdt.encode_delta(batch)
+                self.logger.debug("Replicating {} to {}", value, node)
+                self.send(
+                    node,
+                    {"type": "replicate", "value": value},
+                    callback=self._replicate_ack_handler(outbox, batch, now),
+                    timeout=self.RPC_TIMEOUT)
+
+    def _replicate_ack_handler(self, outbox, batch, sent):
+        def replicate_ack_handler(req):
+            if req["body"]["type"] == "replicate_ok":
+                outbox.ack(batch, time.monotonic() - sent)
+                if len(outbox):
+                    self._replication.mark_dirty()
+        return replicate_ack_handler
+
+    def _changed(self):
+        self._replication.mark_dirty()
+
+    def _merge(self, value):
+        with self.lock:
+            changed = self.crdt.merge(value)
+            if changed:
+                self._snapshot.invalidate()
+                self._log(value)
+            return changed
 
     def read_handler(self, req):
-        with self.set_lock:
-            resp_body = {
-                "type": "read_ok",
-                "value": list(self._set),
-            }
-            self.reply(req, resp_body)
-
-    def add_handler(self, req):
-        with self.set_lock:
-            self._set.add(req["body"]["element"])
-        self.reply(req, {"type": "add_ok"})
+        snapshot = self._snapshot.get()
+        self.reply(req, {"type": "read_ok"}, raw={"value": snapshot.encoded()})
 
     def replicate_handler(self, req):
-        with self.set_lock:
-            self._set = self._set.union(req["body"]["value"])
+        self._merge(req["body"]["value"])
+        self.reply(req, {"type": "replicate_ok"})
 
 
-class GCounterServer(Node):
-    def __init__(self):
-        super().__init__()
+class GSetServer(CrdtServer):
+    DIGEST_INTERVAL = 10
 
-        self._counters = GCounter()
-        self.lock = threading.RLock()
+    def __init__(self, data_dir=None):
+        super().__init__(GSet(), data_dir)
 
-        self.register_handler("read", self.read_handler)
-        self.register_handler("add", self.add_handler)
-        self.register_handler("replicate", self.replicate_handler)
+        self._digest = Digest()
 
-        self._periodic_tasks.append({"f": self._replicate, "dt": 5})
+        self.register_handler("add", self.add_handler, blocking=self._durable)
+        self.register_handler("digest", self.digest_handler, blocking=False)
 
-    def _replicate(self):
-        counter_json = self._counters.to_json()
-        self.log("Replicating set {}", counter_json)
-        for node in self.node_ids:
-            if node != self.node_id:
-                resp_body = {
-                    "type": "replicate",
-                    "value": counter_json,
-                }
-                self.send(node, resp_body)
+        self._periodic_tasks.append(
+            {"f": self._send_digest, "dt": self.DIGEST_INTERVAL})
 
-    def read_handler(self, req):
+    def _send_digest(self):
+        """
+        Anti-entropy, which repairs any divergence the delta replication
+        missed. Digest of the set is sent to a random node, which replies
+        with its elements from the buckets which differ.
+        """
+        if not self._outboxes:
+            return
+        node = random.choice(list(self._outboxes))
         with self.lock:
-            resp_body = {
-                "type": "read_ok",
-                "value": self._counters.sum(),
-            }
-            self.reply(req, resp_body)
+            self._digest.settle(time.monotonic())
+            sums = list(self._digest.sums)
+        self.send(
+            node,
+            {"type": "digest", "digest": sums},
+            callback=self._digest_ack_handler,
+            timeout=self.RPC_TIMEOUT)
+
+    def _digest_ack_handler(self, req):
+        body = req["body"]
+        if body["type"] != "digest_ok" or not body["buckets"]:
+            return
+        self._merge(body["value"])
+
+        # Send back only the elements the other node is missing.
+        theirs = set(body["value"])
+        with self.lock:
+            values = [
+                v for v in self._digest.values(body["buckets"])
+                if v not in theirs
+            ]
+        outbox = self._outboxes.get(req["src"])
+        if values and outbox is not None:
+            outbox.add(values)
+            self._changed()
+
+    def _merge(self, value):
+        now = time.monotonic()
+        with self.lock:
+            new_values = self.crdt.merge(value)
+            for v in new_values:
+                self._digest.add(v, now)
+            if new_values:
+                self._snapshot.invalidate()
+                self._log(new_values)
+        return new_values
 
     def add_handler(self, req):
+        element = req["body"]["element"]
         with self.lock:
-            self._counters = self._counters.add(
-                self.node_id, req["body"]["delta"])
+            added = self.crdt.add(element)
+            if added:
+                self._digest.add(element, time.monotonic())
+                self._snapshot.invalidate()
+                self._log([element])
+        if added:
+            self._changed()
         self.reply(req, {"type": "add_ok"})
 
-    def replicate_handler(self, req):
-        other = GCounter.from_json(req["body"]["value"])
+    def digest_handler(self, req):
         with self.lock:
-            self._counters = self._counters.merge(other)
+            self._digest.settle(time.monotonic())
+            buckets = self._digest.diff(req["body"]["digest"])
+            values = self._digest.values(buckets)
+        self.reply(req, {
+            "type": "digest_ok",
+            "buckets": buckets,
+            "value": values,
+        })
 
 
-class PNCounterServer(Node):
-    def __init__(self):
-        super().__init__()
-
-        self._increment = GCounter()
-        self._decrement = GCounter()
-        self.lock = threading.RLock()
+class CounterServer(CrdtServer):
 
-        self.register_handler("read", self.read_handler)
-        self.register_handler("add", self.add_handler)
-        self.register_handler("replicate", self.replicate_handler)
+    def __init__(self, crdt, data_dir=None):
+        super().__init__(crdt, data_dir)
 
-        self._periodic_tasks.append({"f": self._replicate, "dt": 5})
+        self.register_handler("add", self.add_handler, blocking=self._durable)
 
-    def _replicate(self):
-        inc = self._increment.to_json()
-        dec = self._decrement.to_json()
-        self.log("Replicating set increment {}, decrement {}", inc, dec)
-        for node in self.node_ids:
-            if node != self.node_id:
-                resp_body = {
-                    "type": "replicate",
-                    "value": {
-                        "inc": inc,
-                        "dec": dec,
-                    },
-                }
-                self.send(node, resp_body)
-
-    def read_handler(self, req):
+    def _restored(self):
+        # Other nodes may have missed the last updates of this node before
+        # it was restarted.
         with self.lock:
-            sum = self._increment.sum() - self._decrement.sum()
-            resp_body = {
-                "type": "read_ok",
-                "value": sum,
-            }
-            self.reply(req, resp_body)
+            self.crdt.touch(self.node_id)
+        self._changed()
 
     def add_handler(self, req):
-        delta = req["body"]["delta"]
         with self.lock:
-            if delta > 0:
-                self._increment = self._increment.add(self.node_id, delta)
-            else:
-                # GCounter values has to be positive because of its merge()
-                # function, which uses max() function.
-                self._decrement = self._decrement.add(self.node_id, -delta)
+            self.crdt.add(self.node_id, req["body"]["delta"])
+            self._snapshot.invalidate()
+            self._log(self.crdt.entry(self.node_id))
+        self._changed()
         self.reply(req, {"type": "add_ok"})
 
-    def replicate_handler(self, req):
-        inc = GCounter.from_json(req["body"]["value"]["inc"])
-        dec = GCounter.from_json(req["body"]["value"]["dec"])
-        with self.lock:
-            self._increment = self._increment.merge(inc)
-            self._decrement = self._decrement.merge(dec)
+
+class GCounterServer(CounterServer):
+    def __init__(self, data_dir=None):
+        super().__init__(GCounter(), data_dir)
+
+
+class PNCounterServer(CounterServer):
+    def __init__(self, data_dir=None):
+        super().__init__(PNCounter(), data_dir)
 
 
 class TxnServer(Node):
-    def __init__(self):
+    """
+    Txns are committed in groups. Txns which arrive while a commit is in
+    flight wait and then are all applied to a single new root and committed
+    with single CAS. Thread which finds no commit in flight becomes the
+    committer. Once its group is committed, it hands the role over to the
+    first waiting txn, so that every thread replies as soon as its own txn
+    is committed.
+    """
+    def __init__(self, cache_size=100000, cache_bytes=None):
         super().__init__()
 
         self.lock = threading.RLock()
         self._id_gen = None
         self.state = None
+        self._waiting = []
+        self._committing = False
+        Thunk.configure_cache(cache_size, cache_bytes)
 
-        self.register_handler("txn", self.txn_handler)
+        self.register_handler(
+            "txn", self.txn_handler, coroutine=self.async_txn_handler)
 
     def post_init(self):
         self._id_gen = MonotonicId(self.node_id)
         self.state = TxnState(self, self._id_gen)
+        self.metrics.gauge("txn.cas_retries", lambda: self.state.retries)
+        for name, cache in [("thunk_cache", Thunk.CACHE),
+                            ("root_cache", DbNode.CACHE)]:
+            for stat in cache.stats():
+                self.metrics.gauge(
+                    "{}.{}".format(name, stat),
+                    lambda cache=cache, stat=stat: cache.stats()[stat])
 
     def txn_handler(self, req):
-        txn = req["body"]["txn"]
+        pending = {
+            "txn": req["body"]["txn"],
+            # Set when the txn is done or when it becomes the committer.
+            "wake": threading.Event(),
+            "done": False,
+            "committer": False,
+            "res": None,
+        }
+        with self.lock:
+            self._waiting.append(pending)
+            if not self._committing:
+                self._committing = True
+                pending["committer"] = True
+
+        while not pending["done"]:
+            if pending["committer"]:
+                self._commit_group()
+            else:
+                pending["wake"].wait()
+                pending["wake"].clear()
+        self._reply_txn(req, pending["res"])
+
+    async def async_txn_handler(self, req):
+        """
+        Variant of `txn_handler()` for the asyncio runtime. Txns wait on the
+        loop instead of taking a thread each, only the committer runs in the
+        thread pool. It commits the groups until no txn is waiting.
+        """
+        loop = asyncio.get_running_loop()
+        pending = {
+            "txn": req["body"]["txn"],
+            "future": loop.create_future(),
+            "res": None,
+        }
         with self.lock:
-            try:
-                res = self.state.apply_txn(txn)
-            except MaelstromError as e:
-                self.reply(req, e.to_dict())
+            self._waiting.append(pending)
+            start = not self._committing
+            self._committing = True
+        if start:
+            loop.run_in_executor(None, self._commit_groups, loop)
+        self._reply_txn(req, await pending["future"])
+
+    def _commit_groups(self, loop):
+        while True:
+            for pending in self._apply_group():
+                loop.call_soon_threadsafe(
+                    pending["future"].set_result, pending["res"])
+            with self.lock:
+                if not self._waiting:
+                    self._committing = False
+                    return
+
+    def _reply_txn(self, req, res):
+        if isinstance(res, MaelstromError):
+            self.reply(req, res.to_dict())
+        else:
+            self.reply(req, {
+                "type": "txn_ok",
+                "txn": res,
+            })
+
+    def _commit_group(self):
+        for pending in self._apply_group():
+            pending["done"] = True
+            pending["wake"].set()
+
+        with self.lock:
+            if self._waiting:
+                successor = self._waiting[0]
+                successor["committer"] = True
+                successor["wake"].set()
             else:
-                self.reply(req, {
-                    "type": "txn_ok",
-                    "txn": res,
-                })
+                self._committing = False
+
+    def _apply_group(self):
+        """
+        Commit the waiting txns and the txns which arrive in the meantime.
+        Returns the group with result of each txn in `res`.
+        """
+        with self.lock:
+            group = self._waiting
+            self._waiting = []
+
+        def more():
+            # Txns arrived while the group is being committed are added to
+            # the group when the commit is retried.
+            with self.lock:
+                arrived = self._waiting
+                self._waiting = []
+            group.extend(arrived)
+            return [p["txn"] for p in arrived]
+
+        try:
+            results = self.state.apply_txns([p["txn"] for p in group], more)
+        except Exception as e:
+            if not isinstance(e, MaelstromError):
+                e = AbortError(str(e))
+            results = [e] * len(group)
+
+        for pending, res in zip(group, results):
+            pending["res"] = res
+        return group
@@ -0,0 +1,163 @@
+import mmap
+import os
+import shutil
+import threading
+
+import codec
+
+
+class Storage:
+    """
+    Durable state of a CRDT in directory `path`. Every change is appended to
+    write-ahead log as single JSON line in the same format `merge()` of the
+    CRDT accepts. Once the log grows over `compact_size` bytes, the log is
+    compacted into a snapshot of the whole state.
+
+    As merges are idempotent, the state is restored by merging the snapshot
+    and all the log records, and it doesn't matter if some records are
+    already included in the snapshot. This allows to write the snapshot
+    without holding the lock of the CRDT: the log is only rotated under the
+    lock and the rotated log is removed once the snapshot is written.
+
+    Records are written without fsync, so they survive crash of the node
+    process, but not of the whole machine.
+    """
+    SNAPSHOT = "snapshot.json"
+    LOG = "wal.jsonl"
+    OLD_LOG = "wal.old.jsonl"
+
+    def __init__(self, path, compact_size=4 * 1024 * 1024):
+        self.path = path
+        self.compact_size = compact_size
+        self.log_size = 0
+        self._log = None
+        self._compacting = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        """
+        Returns list of values to merge to restore the state and opens the
+        log for appending.
+        """
+        values = []
+        # Snapshot is decoded at once, which needs a copy of the whole file
+        # anyway. Only the logs are mapped, their records are decoded one by
+        # one.
+        try:
+            with open(self._file(self.SNAPSHOT), "rb") as f:
+                snapshot = f.read()
+        except FileNotFoundError:
+            snapshot = None
+        if snapshot:
+            values.append(codec.decode(snapshot))
+        for name in (self.OLD_LOG, self.LOG):
+            log = _map(self._file(name))
+            if log is None:
+                continue
+            with log:
+                end = _read_records(log, values)
+                size = len(log)
+            if end < size:
+                # Last record was written only partially by a crashed node.
+                os.truncate(self._file(name), end)
+
+        if os.path.exists(self._file(self.OLD_LOG)):
+            # Compaction didn't finish, the rotated log isn't included in the
+            # snapshot, so it's kept as the beginning of the current log.
+            self._append_log()
+            os.replace(self._file(self.OLD_LOG), self._file(self.LOG))
+
+        self._open_log()
+        return values
+
+    def _append_log(self):
+        """
+        Move records of the current log to the end of the rotated log.
+        """
+        with open(self._file(self.OLD_LOG), "ab") as old:
+            if os.path.exists(self._file(self.LOG)):
+                with open(self._file(self.LOG), "rb") as log:
+                    shutil.copyfileobj(log, old)
+                old.flush()
+                os.remove(self._file(self.LOG))
+
+    def _open_log(self):
+        self._log = open(self._file(self.LOG), "ab", buffering=0)
+        self.log_size = self._log.tell()
+
+    def append(self, value):
+        """
+        Append a change to the log. Has to be called under the lock of the
+        CRDT, together with the change.
+        """
+        record = codec.encode_line(value)
+        self._log.write(record)
+        self.log_size += len(record)
+
+    def needs_compaction(self):
+        return self.log_size >= self.compact_size
+
+    def rotate(self):
+        """
+        Start a new log. Has to be called under the lock of the CRDT,
+        together with taking the state passed to `compact()`. Returns
+        `False` if the previous compaction is still running.
+        """
+        if not self._compacting.acquire(blocking=False):
+            return False
+        self._log.close()
+        if os.path.exists(self._file(self.OLD_LOG)):
+            # Previous compaction failed, the rotated log isn't included in
+            # any snapshot yet and the new snapshot has to include both.
+            self._append_log()
+        else:
+            os.replace(self._file(self.LOG), self._file(self.OLD_LOG))
+        self._open_log()
+        return True
+
+    def compact(self, state):
+        """
+        Write the snapshot of `state` and remove the rotated log, which is
+        included in it.
+        """
+        try:
+            tmp = self._file(self.SNAPSHOT + ".tmp")
+            with open(tmp, "wb") as f:
+                f.write(codec.encode(state))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._file(self.SNAPSHOT))
+            os.remove(self._file(self.OLD_LOG))
+        finally:
+            self._compacting.release()
+
+
+def _map(path):
+    """
+    Map the file into memory, returns `None` if it's missing or empty.
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+
+
+def _read_records(log, values):
+    """
+    Decode complete lines of the mapped log into `values`. Returns the end
+    of the last complete line.
+    """
+    start = 0
+    end = log.find(b"\n")
+    while end >= 0:
+        if end > start:
+            values.append(codec.decode(log[start:end]))
+        start = end + 1
+        end = log.find(b"\n", start)
+    return start
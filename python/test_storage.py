@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+from storage import Storage
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_rotate_after_failed_compaction_keeps_records(self):
+        storage = Storage(self.path)
+        self.assertEqual(storage.load(), [])
+        storage.append([1])
+        storage.append([2])
+
+        self.assertTrue(storage.rotate())
+        # Encoding of the state fails, e.g. as writing it would on ENOSPC.
+        with self.assertRaises(TypeError):
+            storage.compact(object())
+        self.assertTrue(
+            os.path.exists(os.path.join(self.path, Storage.OLD_LOG)))
+
+        storage.append([3])
+        self.assertTrue(storage.rotate())
+        storage.append([4])
+
+        # Node crashes before the next compaction succeeds.
+        self.assertEqual(Storage(self.path).load(), [[1], [2], [3], [4]])
+
+    def test_compaction_after_failed_compaction(self):
+        storage = Storage(self.path)
+        storage.load()
+        storage.append([1])
+        self.assertTrue(storage.rotate())
+        with self.assertRaises(TypeError):
+            storage.compact(object())
+
+        storage.append([2])
+        self.assertTrue(storage.rotate())
+        storage.compact([1, 2])
+        storage.append([3])
+
+        self.assertFalse(
+            os.path.exists(os.path.join(self.path, Storage.OLD_LOG)))
+        self.assertEqual(Storage(self.path).load(), [[1, 2], [3]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from linkv import LinKv
+from node import Node
+from transfer_types import DbNode, MonotonicId, TxnState
+
+
+def txn_state(node_id, lin_kv):
+    node = Node()
+    node.node_id = node_id
+    node.register_service("lin-kv", lin_kv)
+    return TxnState(node, MonotonicId(node_id))
+
+
+class TxnStateTest(unittest.TestCase):
+
+    def test_retry_with_more_txns_after_segment_rollover(self):
+        lin_kv = LinKv()
+        n1 = txn_state("n1", lin_kv)
+        n2 = txn_state("n2", lin_kv)
+
+        size = DbNode.SEGMENT_SIZE
+        n1.apply_txn([["append", 1, i] for i in range(size - 1)])
+        # Root of n1 is now stale, but the head of key 1 isn't changed.
+        n2.apply_txn([["append", 2, 0]])
+
+        late = [["append", 1, 100 + i] for i in range(size)]
+        arrived = [[late]]
+
+        def more():
+            return arrived.pop() if arrived else []
+
+        # First append fills the segment of key 1, so its head is left with
+        # no items both in the first attempt and in the retry with `late`.
+        results = n1.apply_txns([[["append", 1, size - 1]]], more)
+
+        expected = list(range(size)) + [100 + i for i in range(size)]
+        self.assertEqual(len(results), 2)
+        self.assertEqual(
+            txn_state("n3", lin_kv).apply_txn([["r", 1, None]]),
+            [["r", 1, expected]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import random
+
+
+# All the functions return the same topology on all the nodes, as long as the
+# nodes are given the same list of node IDs. Topology is a dict mapping node ID
+# to the list of its neighbors.
+
+
+def tree(node_ids, fanout):
+    """
+    Balanced tree, where each node has up to `fanout` children. Diameter of
+    the tree grows only logarithmically with the number of nodes.
+    """
+    nodes = sorted(node_ids)
+    topo = {node: [] for node in nodes}
+    for i, node in enumerate(nodes[1:], start=1):
+        parent = nodes[(i - 1) // fanout]
+        topo[parent].append(node)
+        topo[node].append(parent)
+    return topo
+
+
+def small_world(node_ids, fanout, seed=0):
+    """
+    Ring where each node is connected to `fanout // 2` nearest nodes on both
+    sides, plus one random long-range link per node, which shortens the
+    paths between distant nodes.
+    """
+    nodes = sorted(node_ids)
+    n = len(nodes)
+    edges = {node: set() for node in nodes}
+
+    def connect(a, b):
+        if a != b:
+            edges[a].add(b)
+            edges[b].add(a)
+
+    for i, node in enumerate(nodes):
+        for d in range(1, max(1, fanout // 2) + 1):
+            connect(node, nodes[(i + d) % n])
+
+    rnd = random.Random(seed)
+    for node in nodes:
+        connect(node, rnd.choice(nodes))
+
+    return {node: sorted(neighbors) for node, neighbors in edges.items()}
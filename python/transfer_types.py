@@ -1,72 +1,327 @@
-import json
 import random
 import threading
 import time
+import zlib
 
+import codec
+from cache import LRUCache
 from errors import AbortError
+from errors import MaelstromError
+from errors import NotSupportedError
 from errors import TxnConflictError
 
 
+# Delta-state CRDTs. State is mutated in place and changes made by local
+# updates are collected in a delta buffer. `take_delta()` returns the delta as
+# dict of items (hashable key -> value), which can be shipped to other nodes
+# independently. `encode_delta()` converts any subset of the items to JSON and
+# `merge()` merges such JSON into the state. Merges are idempotent, so the
+# deltas can be re-sent or delivered out of order. The CRDTs are not thread
+# safe, the callers have to synchronize the access.
+
+
 class GCounter:
-    def __init__(self, counters=dict()):
-        self.counters = counters
+    __slots__ = ("counters", "_sum", "_delta")
+
+    def __init__(self, counters=None):
+        self.counters = dict(counters) if counters else {}
+        self._sum = sum(self.counters.values())
+        self._delta = set()
 
     def sum(self):
-        s = 0
-        for v in self.counters.values():
-            s += v
-        return s
+        return self._sum
 
-    def add(self, node_id, increment):
-        counters = self.counters.copy()
-        counters[node_id] = counters.get(node_id, 0) + increment
-        return GCounter(counters)
+    def value(self):
+        return self._sum
 
-    def merge(self, other):
-        merge_counter = {**self.counters, **other.counters}
-        for k in merge_counter.keys():
-            if k in self.counters and k in other.counters:
-                merge_counter[k] = max(self.counters[k], other.counters[k])
-        return GCounter(merge_counter)
+    def add(self, node_id, increment):
+        if increment < 0:
+            # Merge uses max() function, so the counters can only grow.
+            raise ValueError("GCounter can be only incremented")
+        self.counters[node_id] = self.counters.get(node_id, 0) + increment
+        self._sum += increment
+        self._delta.add(node_id)
+
+    def merge(self, counters):
+        """
+        Returns `True` if any counter has changed.
+        """
+        changed = False
+        for node_id, count in counters.items():
+            current = self.counters.get(node_id, 0)
+            if count > current:
+                self.counters[node_id] = count
+                self._sum += count - current
+                changed = True
+        return changed
+
+    def take_delta(self):
+        delta = {node_id: self.counters[node_id] for node_id in self._delta}
+        self._delta.clear()
+        return delta
+
+    def encode_delta(self, items):
+        return dict(items)
+
+    def entry(self, node_id):
+        """
+        JSON of the counter of given node, which can be merged.
+        """
+        return {node_id: self.counters.get(node_id, 0)}
+
+    def touch(self, node_id):
+        """
+        Add the counter of given node to the delta again.
+        """
+        if node_id in self.counters:
+            self._delta.add(node_id)
 
     def to_json(self):
-        return json.dumps(self.counters)
+        return dict(self.counters)
 
     @classmethod
     def from_json(cls, counters):
-        return GCounter(json.loads(counters))
+        return GCounter(counters)
+
+
+class PNCounter:
+    __slots__ = ("inc", "dec")
+
+    def __init__(self):
+        self.inc = GCounter()
+        self.dec = GCounter()
+
+    def value(self):
+        return self.inc.sum() - self.dec.sum()
+
+    def add(self, node_id, delta):
+        if delta > 0:
+            self.inc.add(node_id, delta)
+        elif delta < 0:
+            self.dec.add(node_id, -delta)
+
+    def merge(self, value):
+        """
+        Returns `True` if the value has changed.
+        """
+        inc_changed = self.inc.merge(value["inc"])
+        dec_changed = self.dec.merge(value["dec"])
+        return inc_changed or dec_changed
+
+    def take_delta(self):
+        delta = {}
+        for node_id, count in self.inc.take_delta().items():
+            delta[("inc", node_id)] = count
+        for node_id, count in self.dec.take_delta().items():
+            delta[("dec", node_id)] = count
+        return delta
+
+    def encode_delta(self, items):
+        value = {"inc": {}, "dec": {}}
+        for (kind, node_id), count in items.items():
+            value[kind][node_id] = count
+        return value
+
+    def entry(self, node_id):
+        return {"inc": self.inc.entry(node_id), "dec": self.dec.entry(node_id)}
+
+    def touch(self, node_id):
+        self.inc.touch(node_id)
+        self.dec.touch(node_id)
+
+    def to_json(self):
+        return {"inc": self.inc.to_json(), "dec": self.dec.to_json()}
+
+
+class GSet:
+    __slots__ = ("values", "_delta")
+
+    def __init__(self, values=None):
+        self.values = set(values) if values else set()
+        self._delta = []
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def value(self):
+        return list(self.values)
+
+    def add(self, value):
+        """
+        Returns `True` if the value wasn't in the set yet.
+        """
+        if value in self.values:
+            return False
+        self.values.add(value)
+        self._delta.append(value)
+        return True
+
+    def merge(self, values):
+        """
+        Returns list of values, which weren't in the set yet.
+        """
+        new_values = [v for v in values if v not in self.values]
+        self.values.update(new_values)
+        return new_values
+
+    def take_delta(self):
+        delta = {value: value for value in self._delta}
+        self._delta = []
+        return delta
+
+    def encode_delta(self, items):
+        return list(items)
+
+    def to_json(self):
+        return list(self.values)
+
+
+class Snapshot:
+    """
+    Immutable copy of a value at given version. Encoded value is cached, so
+    it can be sent many times without encoding it again.
+    """
+    __slots__ = ("version", "value", "_encode", "_encoded")
+
+    def __init__(self, version, value, encode=codec.encode):
+        self.version = version
+        self.value = value
+        self._encode = encode
+        self._encoded = None
+
+    def encoded(self):
+        # Racing threads may encode the value twice, but the result is the
+        # same.
+        if self._encoded is None:
+            self._encoded = self._encode(self.value)
+        return self._encoded
+
+
+class SnapshotCache:
+    """
+    Keeps the latest snapshot of a mutable value. Writers have to call
+    `invalidate()` while holding the `lock` guarding the value. Readers
+    call `get()` without any lock. Unless the value changed since the last
+    read, it returns the cached snapshot, otherwise new snapshot is built by
+    `build` function under the lock. The snapshot is encoded by `encode`
+    function, outside of the lock.
+    """
+
+    def __init__(self, lock, build, encode=codec.encode):
+        self._lock = lock
+        self._build = build
+        self._encode = encode
+        self._version = 0
+        self._snapshot = None
+
+    def invalidate(self):
+        self._version += 1
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self._version:
+            return snapshot
+        with self._lock:
+            snapshot = Snapshot(self._version, self._build(), self._encode)
+            self._snapshot = snapshot
+        return snapshot
 
 
 class TxnState:
     SERVICE = "lin-kv"
     KEY = "root"
+    # Time in seconds each txn can spend retrying.
+    RETRY_TIMEOUT = 10
+    RETRY_BACKOFF = 0.005
+    MAX_RETRY_BACKOFF = 0.05
 
     def __init__(self, node, id_gen):
         self._node = node
         self.id_gen = id_gen
+        self.retries = 0
         self.db_node = DbNode(
                 self._node, self.id_gen, self.id_gen.next(), {}, False)
 
     def apply_txn(self, txn):
+        res = self.apply_txns([txn])[0]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def apply_txns(self, txns, more=None):
+        """
+        Commit multiple txns with single CAS. See `DbNode.apply_txns()`.
+
+        On conflict, the commit is retried on the latest root after capped
+        exponential backoff with full jitter. Retry reuses the heads of the
+        keys which were not changed in the meantime. `more` is an optional
+        function returning txns, which arrived in the meantime and which are
+        committed together with the retry, to avoid another conflict.
+
+        Each txn can be retried for `RETRY_TIMEOUT` seconds since it joined
+        the commit, then it's dropped from the commit and its result is
+        `TxnConflictError`. Returns results of `txns` followed by the results
+        of the txns returned by `more`.
+        """
+        txns = list(txns)
+        results = [None] * len(txns)
+        deadline = time.monotonic() + self.RETRY_TIMEOUT
+        deadlines = [deadline] * len(txns)
+        active = list(range(len(txns)))
+        attempt = None
+        retry = 0
         while True:
-            new_db, res = self.db_node.apply_txn(txn)
+            new_db, active_results = self.db_node.apply_txns(
+                [txns[i] for i in active], attempt)
+            # Read-only txns don't change the root, but it still has to be
+            # CASed to make sure they read the latest state.
             new_db.save()
-            if self.db_node != new_db:
-                try:
-                    self._lin_kv_cas(self.KEY, self.db_node.id(), new_db.id())
-                except TxnConflictError:
-                    time.sleep(random.random() * 0.05)
-                    self.db_node = self._lin_kv_read(self.KEY)
-                else:
-                    self.db_node = new_db
-                    return res
+            try:
+                self._lin_kv_cas(self.KEY, self.db_node.id(), new_db.id())
+            except TxnConflictError:
+                pass
+            else:
+                self.db_node = new_db
+                for i, res in zip(active, active_results):
+                    results[i] = res
+                return results
+
+            attempt = new_db
+            self.retries += 1
+            time.sleep(random.uniform(0, min(
+                self.MAX_RETRY_BACKOFF, self.RETRY_BACKOFF * 2 ** retry)))
+            retry += 1
+            self.db_node = DbNode(
+                self._node,
+                self.id_gen,
+                self._lin_kv_read(self.KEY),
+                None,
+                True)
+
+            now = time.monotonic()
+            for i in active:
+                if now >= deadlines[i]:
+                    results[i] = TxnConflictError(
+                        "Txn not committed in {}s".format(self.RETRY_TIMEOUT))
+            active = [i for i in active if results[i] is None]
+            if more:
+                arrived = more()
+                active.extend(range(len(txns), len(txns) + len(arrived)))
+                txns.extend(arrived)
+                results.extend([None] * len(arrived))
+                deadlines.extend([now + self.RETRY_TIMEOUT] * len(arrived))
+            if not active:
+                return results
 
     def _lin_kv_read(self, key):
         req = {
             "type": "read",
             "key": key,
         }
-        resp = self._node.service_rpc(self.SERVICE, req)
+        resp = self._node.service_rpc(self.SERVICE, req).result()
         return resp["body"].get("value")
 
     def _lin_kv_cas(self, key, current, new):
@@ -77,38 +332,11 @@ class TxnState:
             "to": new,
             "create_if_not_exists": True,
         }
-        resp = self._node.service_rpc(self.SERVICE, req)
+        resp = self._node.service_rpc(self.SERVICE, req).result()
         if resp["body"]["type"] != "cas_ok":
             raise TxnConflictError(resp["body"]["text"])
 
 
-class ServiceRequest:
-    TIMEOUT = 5
-
-    def __init__(self):
-        self.lock = threading.RLock()
-        self.finish = threading.Event()
-        self.value = None
-
-    def wait(self):
-        self.finish.clear()
-
-        if self.value:
-            return self.value
-
-        self.finish.wait(self.TIMEOUT)
-
-        if self.value:
-            return self.value
-        else:
-            raise Exception("Timeout while waiting for service response.")
-
-    def set(self, value):
-        with self.lock:
-            self.value = value
-            self.finish.set()
-
-
 class MonotonicId:
 
     def __init__(self, node_id):
@@ -122,9 +350,19 @@ class MonotonicId:
         return "{}-{}".format(self._node_id, self._id)
 
 
+def encoded_size(value):
+    return len(codec.encode(value))
+
+
 class Thunk:
+    """
+    Value stored in lin-kv under unique ID. Once saved, the value never
+    changes, so it can be cached for as long as needed. Cache is
+    write-through, values saved by the node are never read back from lin-kv
+    unless they are evicted.
+    """
     SERVICE = "lin-kv"
-    CACHE = {}
+    CACHE = LRUCache(max_items=100000, sizeof=encoded_size)
 
     def __init__(self, node, id, value, saved):
         self.node = node
@@ -136,12 +374,8 @@ class Thunk:
         return self._id
 
     @classmethod
-    def cached(cls, id):
-        return cls.CACHE[id] if id in cls.CACHE else None
-
-    @classmethod
-    def cache(cls, id, value):
-        cls.CACHE[id] = value
+    def configure_cache(cls, max_items, max_bytes=None):
+        cls.CACHE = LRUCache(max_items, max_bytes, encoded_size)
 
     def to_json(self):
         return self._value
@@ -151,103 +385,308 @@ class Thunk:
 
     def value(self):
         if self._value is None:
-            body = {
-                "type": "read",
-                "key": self._id,
-            }
-            resp = self.node.service_rpc(self.SERVICE, body)
-            try:
-                self._value = self.from_json(resp["body"]["value"])
-            except KeyError:
-                self._value = {}
-
+            Thunk.load_all([self])
         return self._value
 
+    def _read(self):
+        body = {
+            "type": "read",
+            "key": self._id,
+        }
+        return self.node.service_rpc(self.SERVICE, body)
+
+    def _loaded(self, resp):
+        try:
+            value = self.from_json(resp["body"]["value"])
+        except KeyError:
+            value = {}
+        self.CACHE.put(self._id, value)
+        self._value = value
+
+    @staticmethod
+    def load_all(thunks):
+        """
+        Resolve values of all the thunks. Values which are not cached are
+        read all at once and then waited for together, so loading takes
+        single round trip.
+        """
+        reads = []
+        for thunk in thunks:
+            if thunk._value is None:
+                value = thunk.CACHE.get(thunk._id)
+                if value is None:
+                    reads.append((thunk, thunk._read()))
+                else:
+                    thunk._value = value
+        for thunk, future in reads:
+            thunk._loaded(future.result())
+
     def save(self):
-        if not self.saved:
-            body = {
-                "type": "write",
-                "key": self.id(),
-                "value": self.to_json(),
-            }
-            resp = self.node.service_rpc(self.SERVICE, body)
-
-            if resp["body"]["type"] == "write_ok":
-                self.saved = True
-            else:
-                raise AbortError("Unable to save thunk {}".format(self._id()))
+        Thunk.save_all([self])
 
+    def _write(self):
+        body = {
+            "type": "write",
+            "key": self.id(),
+            "value": self.to_json(),
+        }
+        return self.node.service_rpc(self.SERVICE, body)
 
-class DbNode(Thunk):
+    def _written(self, resp):
+        if resp["body"]["type"] == "write_ok":
+            self.saved = True
+            self.CACHE.put(self._id, self._value)
+        else:
+            raise AbortError("Unable to save thunk {}".format(self.id()))
+
+    @staticmethod
+    def save_all(thunks):
+        """
+        Save all unsaved thunks. Writes are sent all at once and then waited
+        for together, so saving takes single round trip.
+        """
+        writes = [(t, t._write()) for t in thunks if not t.saved]
+        for thunk, future in writes:
+            thunk._written(future.result())
 
-    def __init__(self, node, id_gen, id, value, saved):
+
+def partition(key, partitions):
+    # Built-in hash() is randomized per process, all the nodes have to map
+    # the key to the same partition.
+    return str(zlib.crc32(key.encode()) % partitions)
+
+
+class DbNode(Thunk):
+    """
+    Root of the database. Keys are hash-partitioned, root maps partitions to
+    partition thunks and partition thunk maps keys to list heads. List is
+    stored as immutable segments of up to `SEGMENT_SIZE` values and a head,
+    which contains IDs of the segments and values appended since the last
+    segment was created:
+
+        root: {partition: partition_id}
+        partition: {key: head_id}
+        head: {"segments": [segment_id, ...], "items": [value, ...]}
+        segment: [value, ...]
+
+    Txn writes only new heads of the keys it appends to, their partitions,
+    and the root, so the size of the writes doesn't grow with the history.
+    All the roots are still committed by CAS of a single lin-kv key, as
+    lin-kv cannot CAS multiple keys atomically.
+    """
+    PARTITIONS = 16
+    SEGMENT_SIZE = 32
+    # Root values are small, but they are read after every conflict.
+    CACHE = LRUCache(max_items=64)
+
+    def __init__(self, node, id_gen, id, value, saved, unsaved=()):
         super().__init__(node, id, value, saved)
         self.id_gen = id_gen
-
-    def to_json(self):
-        db_map = {}
-        for key, thunks in self.value().items():
-            thunks_ids = []
-            for thunk in thunks:
-                thunks_ids.append(thunk.id())
-            db_map[key] = thunks_ids
-        return json.dumps(db_map)
-
-    def from_json(self, db_json):
-        db_map = {}
-        pairs = json.loads(db_json)
-        if pairs:
-            for key, thunk_ids in pairs.items():
-                thunks = []
-                for id in thunk_ids:
-                    thunk = Thunk.cached(id)
-                    if not thunk:
-                        thunk = Thunk(self.node, id, None, True)
-                        Thunk.cache(id, thunk)
-                    thunks.append(thunk)
-                db_map[key] = thunks
-        return db_map
+        # Thunks of the txns, which created this root.
+        self._unsaved = list(unsaved)
+        # Heads and partitions created by the txns, with IDs of the heads they
+        # were based on and values appended to them. Used to reuse them when
+        # the commit is retried.
+        self._bases = {}
+        self._appended = {}
+        self._heads = {}
+        self._partitions = {}
 
     def save(self):
-        for thunks in self._value.values():
-            for thunk in thunks:
-                thunk.save()
-            super().save()
-
-    def get(self, key):
-        thunks = self.value().get(key)
-        if thunks:
-            values = []
-            for thunk in thunks:
-                values.append(thunk.value())
-            return values
+        # Root is independent of the thunks until it's CASed, so it can be
+        # written together with them.
+        Thunk.save_all(self._unsaved + [self])
+
+    def _thunk(self, id):
+        return Thunk(self.node, id, None, True)
+
+    def load(self, keys, read_keys):
+        """
+        Load partitions and heads of all the keys and segments of the keys
+        which are read. Each level is loaded in single round trip.
+        """
+        root = self.value()
+        partitions = {}
+        for key in keys:
+            p = partition(key, self.PARTITIONS)
+            if p in root and p not in partitions:
+                partitions[p] = self._thunk(root[p])
+        Thunk.load_all(partitions.values())
+
+        heads = {}
+        for key in keys:
+            p = partition(key, self.PARTITIONS)
+            if p in partitions and key in partitions[p].value():
+                heads[key] = self._thunk(partitions[p].value()[key])
+        Thunk.load_all(heads.values())
+
+        segments = {}
+        for key in read_keys:
+            if key in heads:
+                for id in heads[key].value()["segments"]:
+                    segments[id] = self._thunk(id)
+        Thunk.load_all(segments.values())
+
+        return partitions, heads, segments
+
+    def apply_txns(self, txns, attempt=None):
+        """
+        Apply txns one after another and return new root with all their
+        changes and list of results. Result is either the result of the txn,
+        or an exception, if the txn failed. Failed txn doesn't change the
+        root.
+
+        `attempt` is a root created by previous attempt to commit the same
+        txns, which failed. Heads of the keys, which haven't changed since
+        the attempt, are reused together with their partitions, as they are
+        already saved.
+        """
+        keys = {str(key) for txn in txns for _, key, _ in txn}
+        read_keys = {
+            str(key) for txn in txns for fn, key, _ in txn if fn == "r"
+        }
+        partitions, heads, segments = self.load(keys, read_keys)
+
+        # New heads of the keys changed by the txns and segments they
+        # created.
+        changed = {}
+        new_segments = {}
+        # Values appended to each key.
+        appended = {}
+        results = []
+        for txn in txns:
+            txn_changed = dict(changed)
+            txn_segments = {}
+            txn_appended = {}
+            try:
+                res = self._apply_txn(
+                    txn, heads, segments, txn_changed, txn_segments,
+                    txn_appended)
+            except MaelstromError as e:
+                results.append(e)
+            except Exception as e:
+                results.append(AbortError(str(e)))
+            else:
+                results.append(res)
+                changed = txn_changed
+                for db_key, thunks in txn_segments.items():
+                    new_segments.setdefault(db_key, []).extend(thunks)
+                for db_key, values in txn_appended.items():
+                    appended.setdefault(db_key, []).extend(values)
+
+        if not changed:
+            return [self, results]
+
+        bases = {
+            db_key: heads[db_key].id() if db_key in heads else None
+            for db_key in changed
+        }
+        reused = attempt._reusable(bases, appended) if attempt else {}
+
+        root = dict(self.value())
+        unsaved = []
+        new_heads = {}
+        new_partitions = {}
+        for db_key, head in changed.items():
+            if db_key in reused:
+                head_thunk = reused[db_key]
+            else:
+                head_thunk = Thunk(self.node, self.id_gen.next(), head, False)
+                unsaved.extend(new_segments.get(db_key, []))
+                unsaved.append(head_thunk)
+            new_heads[db_key] = head_thunk
+            p = partition(db_key, self.PARTITIONS)
+            if p not in new_partitions:
+                new_partitions[p] = dict(
+                    partitions[p].value() if p in partitions else {})
+            new_partitions[p][db_key] = head_thunk.id()
+
+        for p, value in new_partitions.items():
+            partition_thunk = None
+            if attempt:
+                partition_thunk = attempt._partitions.get(p)
+            if partition_thunk is None or partition_thunk.value() != value:
+                partition_thunk = Thunk(
+                    self.node, self.id_gen.next(), value, False)
+                unsaved.append(partition_thunk)
+            new_partitions[p] = partition_thunk
+            root[p] = partition_thunk.id()
 
-    def apply_txn(self, txn):
+        db_node = DbNode(
+            self.node,
+            self.id_gen,
+            self.id_gen.next(),
+            root,
+            False,
+            unsaved)
+        db_node._bases = bases
+        db_node._appended = appended
+        db_node._heads = new_heads
+        db_node._partitions = new_partitions
+
+        return [db_node, results]
+
+    def _reusable(self, bases, appended):
+        """
+        Returns heads created by this root, which can be reused by another
+        root, which appends `appended` values to the heads with IDs `bases`.
+        Head can be reused, if it was based on the same head and the same
+        values were appended to it. Comparing only the resulting heads isn't
+        enough, as their items are empty after every new segment.
+        """
+        reusable = {}
+        for db_key, values in appended.items():
+            if db_key not in self._heads:
+                continue
+            if self._bases[db_key] != bases[db_key]:
+                continue
+            if self._appended[db_key] != values:
+                continue
+            reusable[db_key] = self._heads[db_key]
+        return reusable
+
+    def _apply_txn(self, txn, heads, segments, changed, new_segments,
+                   appended):
         res = []
         for fn, key, value in txn:
             # DB is dict str -> list.
             db_key = str(key)
+            head = changed.get(db_key)
+            if head is None and db_key in heads:
+                head = heads[db_key].value()
 
             if fn == "r":
-                res.append([fn, key, self.get(db_key)])
+                if head is None:
+                    res.append([fn, key, None])
+                else:
+                    values = []
+                    for id in head["segments"]:
+                        values.extend(segments[id].value())
+                    values.extend(head["items"])
+                    res.append([fn, key, values])
             elif fn == "append":
                 res.append([fn, key, value])
-                thunk = Thunk(
-                    self.node, self.id_gen.next(), value, False)
-                cur_list = self.value().get(db_key, [])
-                cur_list.append(thunk)
-                self._value[db_key] = cur_list
+                appended.setdefault(db_key, []).append(value)
+                if head is None:
+                    head = {"segments": [], "items": []}
+                head = {
+                    "segments": head["segments"],
+                    "items": head["items"] + [value],
+                }
+                if len(head["items"]) >= self.SEGMENT_SIZE:
+                    segment = Thunk(
+                        self.node, self.id_gen.next(), head["items"], False)
+                    segments[segment.id()] = segment
+                    new_segments.setdefault(db_key, []).append(segment)
+                    head = {
+                        "segments": head["segments"] + [segment.id()],
+                        "items": [],
+                    }
+                changed[db_key] = head
             else:
-                raise Exception("Unknown TXN operation {!r}".format(fn))
-
-        db_node = DbNode(
-            self.node,
-            self.id_gen,
-            self.id_gen.next(),
-            self.value(),
-            False)
-
-        return [db_node, res]
+                raise NotSupportedError(
+                    "Unknown TXN operation {!r}".format(fn))
+        return res
 
     def __eq__(self, other):
         if not isinstance(other, DbNode):
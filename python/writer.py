@@ -0,0 +1,72 @@
+import threading
+
+
+class BatchWriter:
+    """
+    Writes encoded messages from single thread. Messages sent while the
+    previous batch is being written, or within `flush_interval` seconds, are
+    coalesced into a single write, up to `flush_size` bytes.
+
+    If writing to the stream fails, e.g. once Maelstrom closed the pipe, the
+    writer stops and the error is kept in `error`. Later messages are dropped
+    and `flush()` doesn't wait for them.
+    """
+
+    def __init__(self, stream, flush_interval=0, flush_size=64 * 1024):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._cond = threading.Condition(threading.Lock())
+        self._frames = []
+        self._size = 0
+        self._writing = False
+        self._thread = None
+        self.error = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, frame):
+        with self._cond:
+            if self.error is not None:
+                return
+            self._frames.append(frame)
+            self._size += len(frame)
+            if len(self._frames) == 1 or self._size >= self.flush_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        """
+        Block until all the messages written so far are written out.
+        """
+        with self._cond:
+            while (self._frames or self._writing) and self.error is None:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._frames:
+                    self._cond.wait()
+                if self.flush_interval and self._size < self.flush_size:
+                    self._cond.wait(self.flush_interval)
+                frames = self._frames
+                self._frames = []
+                self._size = 0
+                self._writing = True
+
+            try:
+                self.stream.write(b"".join(frames))
+                self.stream.flush()
+            except Exception as e:
+                with self._cond:
+                    self.error = e
+                    self._frames = []
+                    self._writing = False
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()